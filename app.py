@@ -1,6 +1,7 @@
 import os
-import re
+import asyncio
 import logging
+import sqlite3
 import slack
 import ssl as ssl_lib
 import certifi
@@ -8,158 +9,133 @@ import threading
 import datetime
 import math
 import time
+import functools
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Pool
 
-from db import Database
-from stuffquiz import StuffQuiz, StuffQuizPoller
+from db import Database, CONNECTION_POOL, get_data_generation
+from cache import QueueFullError, ResultCache, SingleFlight
+from directory import Directory
+from metrics import METRICS, METRICS_LOG_SECONDS, METRICS_PORT, MetricsReporter, start_metrics_server
+from router import CommandRouter
+from scoreparser import QUIZ_DAYS_OF_WEEK, parse_text_for_scores
+from writer import DatabaseWriter
+from dispatcher import SlackDispatcher
+from quizcalendar import QuizCalendar
+from quizpoller import QuizPoller
+from stuffquiz import StuffQuizSource
 
 
 QUIZ_CHANNEL    = '#quizscores'
 DATABASE_NAME   = 'quiz-scorer.db'
+# number of hardest/easiest quizzes shown by !quizstats
+QUIZ_STATS_LENGTH = 3
+# how long a cached recent leaderboard is good for without any writes
+RECENT_LEADERBOARD_TTL_SECONDS = 10 * 60
+# processes computing leaderboards and quiz stats, and how many more
+# computations can wait for one before requests are turned away. waiting
+# doesn't hold a thread, computations are awaited on the event loop
+PROCESS_POOL_SIZE       = int(os.environ.get('PROCESS_POOL_SIZE', 2))
+COMPUTE_QUEUE_LENGTH    = int(os.environ.get('COMPUTE_QUEUE_LENGTH', 8))
+BUSY_MRKDWN             = 'Too busy right now, try again in a minute :hourglass:'
+# 'sync' handles one event at a time, 'async' has many in flight at once
+RUNTIME         = os.environ.get('RUNTIME', 'sync')
+# threads for database (and other blocking) work off the event loop
+DATABASE_THREADS = int(os.environ.get('DATABASE_THREADS', 4))
+# where new quizzes are polled from
+QUIZ_SOURCES    = [StuffQuizSource()]
 
-# aligned with datetime days of the week (monday=0 etc.)
-WEEK_DAYS = (
-    ('monday', 'mon'),
-    ('tuesday', 'tues'),
-    ('wednesday', 'wed'),
-    ('thursday', 'thurs'),
-    ('friday', 'fri'),
-    ('saturday', 'sat'),
-    ('sunday', 'sun')
-)
-QUIZ_DAYS_OF_WEEK = (0, 1, 2, 3, 4)
 
 PROCESS_POOL = None
+DATABASE_WRITER = None
+SLACK_DISPATCHER = None
+DATABASE_EXECUTOR = ThreadPoolExecutor(max_workers=DATABASE_THREADS, thread_name_prefix='db-reader')
+# blocking web client, for the directory lookups
+WEB_CLIENT = None
+RESULT_CACHE = ResultCache()
+COMPUTATIONS = SingleFlight(PROCESS_POOL_SIZE, COMPUTE_QUEUE_LENGTH)
+# new or renamed users/channels are stored, no need to wait for them
+DIRECTORY = Directory(
+    on_user_changed=lambda user_id, user_name: write_to_database('save_user', user_id, user_name),
+    on_channel_changed=lambda channel_id, channel_name: write_to_database('save_channel', channel_id, channel_name)
+)
+# channel id -> whether it's the quiz channel, resolved once per channel
+CHANNEL_IS_QUIZ_CHANNEL = {}
+# the quiz each score is for, without a query
+QUIZ_CALENDAR = QuizCalendar()
+EVENT_SECONDS = METRICS.histogram('event_seconds', 'Time taken to handle messages, by what they were', ('kind',))
+SCORE_SECONDS = METRICS.histogram('score_seconds', 'Time taken to add a score, by outcome', ('outcome',))
+COMPUTATION_SECONDS = METRICS.histogram('computation_seconds', 'Time taken to compute leaderboards and quiz stats', ('kind',))
+METRICS.gauge('writer_queue_depth', 'Writes waiting for the db-writer', lambda: DATABASE_WRITER.queue.qsize() if DATABASE_WRITER else 0)
+METRICS.gauge('slack_queue_depth', 'Calls waiting for the slack-dispatcher', lambda: SLACK_DISPATCHER.get_queue_depth() if SLACK_DISPATCHER else 0)
+METRICS.gauge('result_cache_hits', 'Leaderboard/quiz stats cache hits', lambda: RESULT_CACHE.hits)
+METRICS.gauge('result_cache_misses', 'Leaderboard/quiz stats cache misses', lambda: RESULT_CACHE.misses)
+METRICS.gauge('computations_coalesced', 'Leaderboard/quiz stats requests that joined a running computation', lambda: COMPUTATIONS.coalesced)
+# user id -> [lock, messages holding or waiting for it]. messages from the
+# same user are handled one at a time in the order they arrived, so the
+# first score is the one stored. entries go once nobody needs them, and
+# start_rtm_client starts afresh for each event loop
+USER_LOCKS = {}
+# spawned message handlers, referenced until they're done
+EVENT_TASKS = set()
+
+
+def log_failed_write(future):
+    if future.exception() is not None:
+        print(f'could not write to database: {future.exception()}')
+
+
+def write_to_database(method_name, *args):
+    # queued for the writer thread, which commits writes in batches.
+    # the returned future resolves once the write has been committed
+    future = DATABASE_WRITER.submit(method_name, *args)
+    future.add_done_callback(log_failed_write)
+    return future
+
+
+async def run_blocking(fn, *args):
+    # runs fn on the database executor so the event loop keeps going
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(DATABASE_EXECUTOR, functools.partial(fn, *args))
 
 
 def get_channel_name(channel_id, web_client):
-    with Database(DATABASE_NAME) as db:
-        # get the channel from persistence
-        channel_name = db.get_channel_name_by_id(channel_id)
-        if channel_name:
-            return channel_name
-        # get the channel name from slack
-        if channel_id.startswith('G'):
-            # private channel
-            response = web_client.groups_info(channel=channel_id)
-            channel_name = response.data['group']['name']
-        elif channel_id.startswith('C'):
-            # ordinary channel
-            response = web_client.channels_info(channel=channel_id)
-            channel_name = response.data['channel']['name']
-        else:
-            print(f'Unknown channel type: {channel_id}')
-            return None
-        # store the channel name
-        db.create_channel(channel_id, channel_name)
-        return channel_name
+    return DIRECTORY.get_channel_name(channel_id, web_client)
 
 
 def get_user_name(user_id, web_client):
+    return DIRECTORY.get_user_name(user_id, web_client)
+
+
+def warm_up_directory(web_client):
+    # names we already know, then everything slack knows
     with Database(DATABASE_NAME) as db:
-        # get the user from persistence
-        user_name = db.get_user_name_by_id(user_id)
-        if user_name:
-            return user_name
-        # get the user name from slack
-        if user_id.startswith('U'):
-            # regular user
-            response = web_client.users_info(user=user_id)
-            user_name = response.data['user']['profile']['display_name']
-        else:
-            print(f'Unknown user type: {user_id}')
-            return None
-        # store the user name
-        db.create_user(user_id, user_name)
-        return user_name
-
-
-def add_reaction(name, channel_id, ts, web_client):
+        DIRECTORY.load(db.get_users(), db.get_channels())
     try:
-        web_client.reactions_add(
-            name=name,
-            channel=channel_id,
-            timestamp=ts
-        )
+        DIRECTORY.warm_up(web_client)
     except Exception as e:
-        print(f'exception while adding reaction: {e}')
-
-
-def strip_emojis(line):
-    return re.sub(r':[0-9A-Za-z._-]+:', '', line)
-
-
-def parse_text_for_marker(text, markers):
-    for marker in markers:
-        if marker in text:
-            return True
-    return False
+        print(f'could not warm up directory: {e}')
 
 
-def parse_text_for_morning(text):
-    return parse_text_for_marker(text.lower(), ('am', 'a.m', 'morning'))
-
-
-def parse_text_for_afternoon(text):
-    return parse_text_for_marker(text.lower(), ('pm', 'p.m', 'afternoon'))
-
-
-def parse_text_for_yesterday(text):
-    return parse_text_for_marker(text.lower(), ('yesterday',))
-
-
-def parse_text_for_days_ago(text):
-    text_lower = text.lower()
-    if 'today' in text_lower:
-        return 0
-    if 'yesterday' in text_lower:
-        return 1
-    # what day is today?
-    today_day = datetime.date.today().weekday()
-    # is a weekday name provided?
-    for day, names in enumerate(WEEK_DAYS):
-        if parse_text_for_marker(text_lower, names):
-            return (today_day - day) % 7
-    # assume today
-    return 0
+def add_reaction(name, channel_id, ts):
+    # sent (and retried) by the dispatcher, which logs it if it fails
+    return SLACK_DISPATCHER.submit(
+        'reactions_add',
+        name=name,
+        channel=channel_id,
+        timestamp=ts
+    )
 
 
-def parse_text_for_scores(text):
-    '''
-    returns scores in the given text as a list of
-    [
-        (score, is_am, is_pm, days_ago)
-        ...
-    ]
-    '''
-    parsed_scores = []
-    for line in text.split('\n'):
-        try:
-            text_scores = re.findall(r'([0-9]{1,2})/15', line)
-        except Exception as e:
-            print(f'exception parsing text for score: {e} ({text})')
-        else:
-            if not text_scores:
-                continue
-            # use the first score on this line
-            score = int(text_scores[0])
-            if score < 0:
-                continue
-            if score > 15:
-                continue
-            text_line = strip_emojis(line)
-            parsed_scores.append((
-                score,
-                parse_text_for_morning(text_line),
-                parse_text_for_afternoon(text_line),
-                parse_text_for_days_ago(text_line)
-            ))
-    return parsed_scores
+def add_stuff_quiz(stuff_quiz):
+    write_to_database('add_quiz', stuff_quiz.id, stuff_quiz.name, stuff_quiz.url, stuff_quiz.ts).result()
+    QUIZ_CALENDAR.add(stuff_quiz.id, stuff_quiz.ts)
 
 
-def add_stuff_quiz(stuff_quiz):
+def load_quiz_calendar():
     with Database(DATABASE_NAME) as db:
-        db.add_quiz(stuff_quiz.id, stuff_quiz.name, stuff_quiz.url, stuff_quiz.ts)
+        QUIZ_CALENDAR.load(db.get_quiz_timestamps())
 
 
 def get_stuff_quiz_by_id(stuff_quiz_id):
@@ -167,37 +143,48 @@ def get_stuff_quiz_by_id(stuff_quiz_id):
         return db.get_quiz_by_id(stuff_quiz_id)
 
 
-def try_add_quiz_score(user_id, channel_id, score, is_am, is_pm, days_ago, ts):
+def get_stuff_quiz_ids():
+    with Database(DATABASE_NAME) as db:
+        return db.get_quiz_ids()
+
+
+def find_quiz_for_score(user_id, is_am, is_pm, days_ago, ts):
+    # returns (quiz id, None) or (None, error message)
     with Database(DATABASE_NAME) as db:
         # get the quiz this score is for
-        quiz = db.find_quiz(ts, is_am, is_pm, days_ago)
-        if not quiz:
-            return 'quiz could not be found'
+        quiz_id = QUIZ_CALENDAR.find_quiz_id(ts, is_am, is_pm, days_ago)
+        if quiz_id is None:
+            # not one the calendar knows about, e.g. added by something else
+            quiz = db.find_quiz(ts, is_am, is_pm, days_ago)
+            if not quiz:
+                return None, 'quiz could not be found'
+            quiz_id = quiz[0]
+            QUIZ_CALENDAR.add(quiz_id, quiz[3])
         # check if a score has not already been added
-        existing_score = db.find_quiz_score(user_id, quiz[0])
+        existing_score = db.find_quiz_score(user_id, quiz_id)
         if existing_score is not None:
-            return f'already added score `{existing_score}` for this quiz'
-        # store score
-        db.add_score(user_id, quiz[0], channel_id, score, ts)
-        return None
+            return None, f'already added score `{existing_score}` for this quiz'
+    return quiz_id, None
 
 
-def alert_channel_about_new_stuff_quiz(stuff_quiz, web_client):
-    web_client.chat_postMessage(
-        channel=QUIZ_CHANNEL,
-        blocks=[
-            {
-                "type": "section",
-                "text": {
-                    "type": "mrkdwn",
-                    "text": f"new quiz :sparkles: <{stuff_quiz.url}|{stuff_quiz.name}>"
-                }
-            }
-        ]
-    )
+async def try_add_quiz_score(user_id, channel_id, score, is_am, is_pm, days_ago, ts):
+    quiz_id, error_message = await run_blocking(find_quiz_for_score, user_id, is_am, is_pm, days_ago, ts)
+    if error_message is not None:
+        return error_message
+    # store score, waiting for the batch it's in to commit
+    try:
+        await asyncio.wrap_future(DATABASE_WRITER.submit('add_score', user_id, quiz_id, channel_id, score, ts))
+    except sqlite3.IntegrityError:
+        # lost a race with another message for the same quiz
+        return 'already added score for this quiz'
+    return None
 
 
-def on_new_stuff_quiz(stuff_quiz, web_client):
+def alert_channel_about_new_stuff_quiz(stuff_quiz):
+    SLACK_DISPATCHER.post_mrkdwn(QUIZ_CHANNEL, f"new quiz :sparkles: <{stuff_quiz.url}|{stuff_quiz.name}>")
+
+
+def on_new_stuff_quiz(stuff_quiz):
     # check the day of week
     quiz_ts_datetime = datetime.datetime.fromtimestamp(float(stuff_quiz.ts))
     weekday = quiz_ts_datetime.weekday()
@@ -211,7 +198,7 @@ def on_new_stuff_quiz(stuff_quiz, web_client):
     # add quiz to db
     add_stuff_quiz(stuff_quiz)
     # send message
-    alert_channel_about_new_stuff_quiz(stuff_quiz, web_client)
+    alert_channel_about_new_stuff_quiz(stuff_quiz)
 
 
 def get_leaderboard_block_all_time(leaderboard):
@@ -291,8 +278,8 @@ def get_leaderboard_block(leaderboard):
 def get_quiz_stats_blocks(quiz_stats):
     # split into easiest and hardest
     midpoint = int(math.ceil(len(quiz_stats) / 2))
-    easiest_quizzes = quiz_stats[:midpoint][:3]
-    hardest_quizzes = list(reversed(quiz_stats[midpoint:][-3:]))
+    easiest_quizzes = quiz_stats[:midpoint][:QUIZ_STATS_LENGTH]
+    hardest_quizzes = list(reversed(quiz_stats[midpoint:][-QUIZ_STATS_LENGTH:]))
 
     def get_winner_mrkdwn(line):
         if line['is_draw']:
@@ -346,188 +333,369 @@ def get_leaderboard(is_all_time=False):
 
 def get_quiz_stats():
     with Database(DATABASE_NAME) as db:
-        return db.get_quiz_stats()
+        return db.get_quiz_stats(QUIZ_STATS_LENGTH)
 
 
-def write_leaderboard_to_channel(channel_id, web_client, is_all_time=False):
-    t0 = time.time()
-    leaderboard = PROCESS_POOL.apply(get_leaderboard, (is_all_time,))
-    t1 = time.time()
-    print(f'DEBUG got leaderboard from db in {(t1-t0):.2f}s')
+def get_leaderboard_blocks_from_db(is_all_time=False):
+    # runs in the process pool, only the blocks are sent back
+    leaderboard = get_leaderboard(is_all_time)
     if is_all_time:
-        block = get_leaderboard_block_all_time(leaderboard)
-    else:
-        block = get_leaderboard_block(leaderboard)
-    web_client.chat_postMessage(
-        channel=channel_id,
-        blocks=[block]
+        return [get_leaderboard_block_all_time(leaderboard)]
+    return [get_leaderboard_block(leaderboard)]
+
+
+def get_quiz_stats_blocks_from_db():
+    return get_quiz_stats_blocks(get_quiz_stats())
+
+
+async def get_leaderboard_result(is_all_time=False):
+    # cached until the next write, and the recent leaderboard also expires
+    # since scores age out of its rolling window
+    kind = 'leaderboard-all-time' if is_all_time else 'leaderboard-recent'
+    ttl_seconds = None if is_all_time else RECENT_LEADERBOARD_TTL_SECONDS
+    return await get_cached_result(kind, ttl_seconds, get_leaderboard_blocks_from_db, is_all_time)
+
+
+async def get_quiz_stats_result():
+    return await get_cached_result('quizstats', None, get_quiz_stats_blocks_from_db)
+
+
+async def get_cached_result(kind, ttl_seconds, fn, *args):
+    generation = get_data_generation()
+    result = RESULT_CACHE.get(kind, generation)
+    if result is not None:
+        return result
+    # everyone asking for the same data while it's being computed shares
+    # the one computation, so a score is always in the result that follows it
+    return await COMPUTATIONS.do((kind, generation), compute_result, kind, generation, ttl_seconds, fn, *args)
+
+
+async def compute_result(kind, generation, ttl_seconds, fn, *args):
+    with COMPUTATION_SECONDS.time(kind=kind):
+        result = await apply_in_process_pool(fn, *args)
+    RESULT_CACHE.put(kind, generation, result, ttl_seconds)
+    return result
+
+
+def apply_in_process_pool(fn, *args):
+    # an asyncio future for fn(*args) in the process pool, so no thread
+    # waits on it
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def resolve(method, value):
+        if not future.done():
+            method(value)
+
+    def resolve_soon(method, value):
+        # called on the pool's result thread
+        try:
+            loop.call_soon_threadsafe(resolve, method, value)
+        except RuntimeError:
+            # the loop has closed (slack reconnected), nobody is waiting
+            pass
+
+    PROCESS_POOL.apply_async(
+        fn,
+        args,
+        callback=lambda result: resolve_soon(future.set_result, result),
+        error_callback=lambda e: resolve_soon(future.set_exception, e)
     )
+    return future
 
 
-def write_quiz_stats_to_channel(channel_id, web_client):
-    t0 = time.time()
-    quiz_stats = PROCESS_POOL.apply(get_quiz_stats)
-    t1 = time.time()
-    print(f'DEBUG got quiz stats from db in {(t1-t0):.2f}s')
-    blocks = get_quiz_stats_blocks(quiz_stats)
-    web_client.chat_postMessage(
+async def write_leaderboard_to_channel(channel_id, is_all_time=False):
+    blocks = await get_leaderboard_result(is_all_time)
+    SLACK_DISPATCHER.submit(
+        'chat_postMessage',
         channel=channel_id,
         blocks=blocks
     )
 
 
-def write_mrkdwn_to_channel(mrkdwn, channel_id, web_client):
-    web_client.chat_postMessage(
+async def write_quiz_stats_to_channel(channel_id):
+    blocks = await get_quiz_stats_result()
+    SLACK_DISPATCHER.submit(
+        'chat_postMessage',
         channel=channel_id,
-        blocks=[
-            {
-                "type": "section",
-                "text": {
-                    "type": "mrkdwn",
-                    "text": mrkdwn
-                }
-            }
-        ]
+        blocks=blocks
     )
 
 
-def write_recent_scores_to_channel(channel_id, name_substring, count, web_client):
+def write_mrkdwn_to_channel(mrkdwn, channel_id, coalesce_key=None):
+    # messages with the same coalesce_key are merged while they're queued
+    return SLACK_DISPATCHER.post_mrkdwn(channel_id, mrkdwn, coalesce_key)
+
+
+def get_recent_scores_mrkdwn(name_substring, count):
     with Database(DATABASE_NAME) as db:
         # try and find a single user
         users = db.find_users_by_name_substring(name_substring)
         if len(users) == 0:
+            return 'No users found'
+        elif len(users) > 1:
+            return 'Multiple users found, please be specific'
+        (user_id, user_name) = users[0]
+        scores = db.find_recent_scores_by_user_id(user_id, count)
+        score_text = ' '.join(f'`{score}`' for score in scores)
+        return f"{user_name}'s last {len(scores)} scores: {score_text}"
+
+
+async def write_recent_scores_to_channel(channel_id, name_substring, count):
+    mrkdwn = await run_blocking(get_recent_scores_mrkdwn, name_substring, count)
+    write_mrkdwn_to_channel(mrkdwn, channel_id)
+
+
+async def write_leaderboard_command(text, channel_id, ts):
+    try:
+        text_lower = text.lower()
+        is_all_time = text_lower.endswith('all-time') or text_lower.endswith('alltime')
+        await write_leaderboard_to_channel(channel_id, is_all_time)
+    except QueueFullError:
+        write_mrkdwn_to_channel(BUSY_MRKDWN, channel_id)
+    except Exception as e:
+        print(f'could not write leaderboard: {e}')
+
+
+async def write_quiz_stats_command(text, channel_id, ts):
+    try:
+        await write_quiz_stats_to_channel(channel_id)
+    except QueueFullError:
+        write_mrkdwn_to_channel(BUSY_MRKDWN, channel_id)
+    except Exception as e:
+        print(f'could not write quiz stats: {e}')
+
+
+async def write_last10_command(text, channel_id, ts):
+    try:
+        name_substring = text[8:]
+        await write_recent_scores_to_channel(channel_id, name_substring, 10)
+    except Exception as e:
+        print(f'could not get last 10 scores: {e}')
+
+
+async def write_last_command(text, channel_id, ts):
+    try:
+        cmd, num, name_substring = text.split()
+        int_num = int(num)
+        if int_num <= 0:
+            add_reaction('dusty_stick', channel_id, ts)
+            return
+        elif int_num > 1000:
             write_mrkdwn_to_channel(
-                'No users found',
-                channel_id,
-                web_client
+                f'Limit = 1000',
+                channel_id
             )
             return
-        elif len(users) > 1:
+
+        await write_recent_scores_to_channel(channel_id, name_substring, int_num)
+    except Exception as e:
+        print(f'could not get last scores: {e}')
+
+
+# TODO: more commands e.g. personal scores
+COMMAND_ROUTER = CommandRouter()
+COMMAND_ROUTER.add('!leaderboard', write_leaderboard_command)
+COMMAND_ROUTER.add('!quizstats', write_quiz_stats_command, exact=True)
+COMMAND_ROUTER.add('!last10 ', write_last10_command)
+COMMAND_ROUTER.add('!last ', write_last_command)
+
+
+def resolve_quiz_channel():
+    # fill in the allowlist from the names the directory has current, the
+    # rest are looked up on their first message
+    for channel_id, channel_name in DIRECTORY.get_channels():
+        CHANNEL_IS_QUIZ_CHANNEL[channel_id] = is_quiz_channel_name(channel_name)
+    quiz_channel_ids = [channel_id for channel_id, is_quiz in CHANNEL_IS_QUIZ_CHANNEL.items() if is_quiz]
+    print(f'quiz channel ids: {quiz_channel_ids}')
+
+
+def is_quiz_channel_name(channel_name):
+    # channels might not have hash prefix, so remove for comparison
+    return channel_name.lstrip('#') == QUIZ_CHANNEL.lstrip('#')
+
+
+async def is_quiz_channel(channel_id):
+    is_quiz = CHANNEL_IS_QUIZ_CHANNEL.get(channel_id)
+    if is_quiz is not None:
+        return is_quiz
+    # first message from a channel we haven't resolved yet
+    channel_name = await run_blocking(get_channel_name, channel_id, WEB_CLIENT)
+    if not channel_name:
+        return False
+    is_quiz = is_quiz_channel_name(channel_name)
+    CHANNEL_IS_QUIZ_CHANNEL[channel_id] = is_quiz
+    return is_quiz
+
+
+@contextlib.asynccontextmanager
+async def user_turn(user_id):
+    # asyncio locks queue their waiters in order, and this is taken before
+    # the handler awaits anything, so turns go in the order messages arrived
+    user_locks = USER_LOCKS
+    entry = user_locks.get(user_id)
+    if entry is None:
+        entry = user_locks[user_id] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0 and user_locks.get(user_id) is entry:
+            del user_locks[user_id]
+
+
+async def add_scores_from_message(text, channel_id, user_id, ts):
+    parsed_scores = parse_text_for_scores(text)
+    if not parsed_scores:
+        return
+
+    # who da perp?
+    user_name = await run_blocking(get_user_name, user_id, WEB_CLIENT)
+    if not user_name:
+        return
+
+    await add_parsed_scores(parsed_scores, user_name, channel_id, user_id, ts)
+
+
+async def add_parsed_scores(parsed_scores, user_name, channel_id, user_id, ts):
+    # add scores
+    for score, is_am, is_pm, days_ago in parsed_scores:
+        print(f'adding score {score} for user {user_name}')
+        t0 = time.perf_counter()
+        error_message = await try_add_quiz_score(user_id, channel_id, score, is_am, is_pm, days_ago, ts)
+        SCORE_SECONDS.observe(time.perf_counter() - t0, outcome='added' if error_message is None else 'rejected')
+
+        if error_message is not None:
+            # a burst of these goes out as one message
             write_mrkdwn_to_channel(
-                'Multiple users found, please be specific',
+                f'Your score `{score}` could not be added: {error_message}',
                 channel_id,
-                web_client
+                coalesce_key=('score-error', channel_id)
             )
-            return
-        (user_id, user_name) = users[0]
-        scores = db.find_recent_scores_by_user_id(user_id, count)
-        score_text = ' '.join(f'`{score}`' for score in scores)
-        mrkdwn = f"{user_name}'s last {len(scores)} scores: {score_text}"
-        write_mrkdwn_to_channel(mrkdwn, channel_id, web_client)
+            continue
 
+        # is the score reaction-worthy?
+        if score in [0, 1]:
+            add_reaction('exploding_head', channel_id, ts)
 
-@slack.RTMClient.run_on(event="message")
-def message(**payload):
-    data = payload["data"]
-    web_client = payload["web_client"]
+        elif score in [14, 15]:
+            add_reaction('fire', channel_id, ts)
+
+
+async def handle_message(data):
+    # returns what kind of message this was, for the event counters
     channel_id = data.get("channel")
     user_id = data.get("user")
     text = data.get("text")
     ts = data.get("ts")
 
-    #print(data)
-    #print(web_client)
-    #print(channel_id)
-    #print(user_id)
-    #print(text)
-
     if not text:
-        return
+        return 'empty'
 
-    if text.lower().startswith('!leaderboard'):
-        try:
-            is_all_time = text.lower().endswith('all-time') or text.lower().endswith('alltime')
-            write_leaderboard_to_channel(channel_id, web_client, is_all_time)
-        except Exception as e:
-            print(f'could not write leaderboard: {e}')
-        return
+    command, handler = COMMAND_ROUTER.match(text)
+    if handler:
+        await handler(text, channel_id, ts)
+        return command
 
-    elif text.lower() == '!quizstats':
-        try:
-            write_quiz_stats_to_channel(channel_id, web_client)
-        except Exception as e:
-            print(f'could not write quiz stats: {e}')
-        return
+    try:
+        # the user's turn comes before any await, see user_turn
+        async with user_turn(user_id):
+            if not await is_quiz_channel(channel_id):
+                return 'other-channel'
 
-    elif text.lower().startswith('!last10 '):
-        try:
-            name_substring = text[8:]
-            write_recent_scores_to_channel(channel_id, name_substring, 10, web_client)
-        except Exception as e:
-            print(f'could not get last 10 scores: {e}')
-        return
+            # nothing that could be a score, e.g. 10/15
+            if '/15' not in text:
+                return 'chatter'
 
-    elif text.lower().startswith('!last '):
-        try:
-            cmd, num, name_substring = text.split()
-            int_num = int(num)
-            if int_num <= 0:
-                add_reaction('dusty_stick', channel_id, ts, web_client)
-                return
-            elif int_num > 1000:
-                write_mrkdwn_to_channel(
-                    f'Limit = 1000',
-                    channel_id,
-                    web_client
-                )
-                return
+            await add_scores_from_message(text, channel_id, user_id, ts)
+            return 'scores'
 
-            write_recent_scores_to_channel(channel_id, name_substring, int_num, web_client)
-        except Exception as e:
-            print(f'could not get last scores: {e}')
-        return
+    except Exception as e:
+        print(f'exception in message(): {e}')
+        return 'error'
 
-    # TODO: more commands e.g. personal scores
 
-    try:
-        channel_name = get_channel_name(channel_id, web_client)
-        if not channel_name:
-            return
+@slack.RTMClient.run_on(event="user_change")
+async def user_change(**payload):
+    user = payload["data"]["user"]
+    DIRECTORY.set_user_name(user["id"], user["profile"]["display_name"])
 
-        # channels might not have hash prefix, so remove for comparison
-        if channel_name.lstrip('#') != QUIZ_CHANNEL.lstrip('#'):
-            return
 
-        parsed_scores = parse_text_for_scores(text)
-        if not parsed_scores:
-            return
+@slack.RTMClient.run_on(event="channel_rename")
+@slack.RTMClient.run_on(event="group_rename")
+async def channel_rename(**payload):
+    channel = payload["data"]["channel"]
+    DIRECTORY.set_channel_name(channel["id"], channel["name"])
+    CHANNEL_IS_QUIZ_CHANNEL[channel["id"]] = is_quiz_channel_name(channel["name"])
 
-        # who da perp?
-        user_name = get_user_name(user_id, web_client)
-        if not user_name:
-            return
 
-        # add scores
-        for score, is_am, is_pm, days_ago in parsed_scores:
-            print(f'adding score {score} for user {user_name}')
-            error_message = try_add_quiz_score(user_id, channel_id, score, is_am, is_pm, days_ago, ts)
+@slack.RTMClient.run_on(event="message")
+async def message(**payload):
+    if RUNTIME == 'async':
+        # don't hold up the next event
+        task = asyncio.ensure_future(handle_message_event(payload["data"]))
+        EVENT_TASKS.add(task)
+        task.add_done_callback(EVENT_TASKS.discard)
+    else:
+        await handle_message_event(payload["data"])
 
-            if error_message is not None:
-                write_mrkdwn_to_channel(
-                    f'Your score `{score}` could not be added: {error_message}',
-                    channel_id,
-                    web_client
-                )
-                continue
 
-            # is the score reaction-worthy?
-            if score in [0, 1]:
-                add_reaction('exploding_head', channel_id, ts, web_client)
+async def handle_message_event(data):
+    t0 = time.perf_counter()
+    kind = await handle_message(data)
+    EVENT_SECONDS.observe(time.perf_counter() - t0, kind=kind.strip())
 
-            elif score in [14, 15]:
-                add_reaction('fire', channel_id, ts, web_client)
 
-    except Exception as e:
-        print(f'exception in message(): {e}')
-        return
+def start_rtm_client(slack_token, ssl_context, proxy):
+    # the rtm client awaits the (coroutine) handlers either way, but only the
+    # async runtime lets them overlap
+    global USER_LOCKS, COMPUTATIONS
+    # locks and computations from a previous loop can't be used on a new one
+    USER_LOCKS = {}
+    COMPUTATIONS = SingleFlight(PROCESS_POOL_SIZE, COMPUTE_QUEUE_LENGTH)
+    if RUNTIME == 'async':
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            rtm_client = slack.RTMClient(token=slack_token, ssl=ssl_context, proxy=proxy, run_async=True, loop=loop)
+            print(f'starting rtm-client (async)')
+            loop.run_until_complete(rtm_client.start())
+        finally:
+            loop.close()
+    else:
+        rtm_client = slack.RTMClient(token=slack_token, ssl=ssl_context, proxy=proxy)
+        print(f'starting rtm-client')
+        rtm_client.start()
 
 
 if __name__ == "__main__":
     # initialize the database
     with Database(DATABASE_NAME) as db:
         db.initialize()
+    load_quiz_calendar()
+    print(f'loaded {len(QUIZ_CALENDAR)} quizzes into the calendar')
 
-    PROCESS_POOL = Pool(2)
+    # the workers open their own connections, don't fork ours into them
+    CONNECTION_POOL.close()
+    PROCESS_POOL = Pool(PROCESS_POOL_SIZE)
+
+    # metrics for prometheus and the log
+    if METRICS_PORT:
+        try:
+            start_metrics_server()
+            print(f'serving metrics on port {METRICS_PORT}')
+        except OSError as e:
+            print(f'could not serve metrics: {e}')
+    if METRICS_LOG_SECONDS:
+        metrics_reporter = MetricsReporter()
+        metrics_reporter.start()
+
+    # start the database writer
+    DATABASE_WRITER = DatabaseWriter(DATABASE_NAME)
+    print(f'starting db-writer')
+    DATABASE_WRITER.start()
 
     ssl_context = ssl_lib.create_default_context(cafile=certifi.where())
     slack_token = os.environ["SLACK_BOT_TOKEN"]
@@ -539,21 +707,28 @@ if __name__ == "__main__":
     else:
         print(f'creating web-client without proxy')
         web_client = slack.WebClient(token=slack_token, ssl=ssl_context)
+    WEB_CLIENT = web_client
+
+    # start the outbound slack dispatcher
+    SLACK_DISPATCHER = SlackDispatcher(web_client)
+    print(f'starting slack-dispatcher')
+    SLACK_DISPATCHER.start()
+
+    # preload user and channel names
+    print(f'warming up directory')
+    warm_up_directory(web_client)
+    resolve_quiz_channel()
 
     # start the stuff quiz poller
-    sq_poller = StuffQuizPoller()
-    sq_poller.on_new_stuff_quiz = lambda sq: on_new_stuff_quiz(sq, web_client)
+    # quizzes we already have don't need their details fetched
+    sq_poller = QuizPoller(QUIZ_SOURCES, known_quiz_ids=get_stuff_quiz_ids())
+    sq_poller.on_new_quiz = on_new_stuff_quiz
     print(f'starting sq-poller')
     sq_poller.start()
 
     while True:
         try:
-            if proxy:
-                rtm_client = slack.RTMClient(token=slack_token, ssl=ssl_context, proxy=proxy)
-            else:
-                rtm_client = slack.RTMClient(token=slack_token, ssl=ssl_context)
-            print(f'starting rtm-client')
-            rtm_client.start()
+            start_rtm_client(slack_token, ssl_context, proxy)
         except KeyboardInterrupt:
             print('exiting...')
             break
@@ -572,3 +747,15 @@ if __name__ == "__main__":
     print(f'sq-poller has stopped')
     PROCESS_POOL.join()
     print(f'process-pool is closed')
+    DATABASE_EXECUTOR.shutdown()
+    print(f'stopping slack-dispatcher')
+    SLACK_DISPATCHER.stop()
+    print(f'slack-dispatcher has stopped')
+    print(f'stopping db-writer')
+    DATABASE_WRITER.stop()
+    DATABASE_WRITER.join()
+    print(f'db-writer has stopped')
+    CONNECTION_POOL.close()
+    if METRICS_LOG_SECONDS:
+        metrics_reporter.stop()
+    print(f'metrics:\n{METRICS.get_summary()}')
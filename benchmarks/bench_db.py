@@ -0,0 +1,148 @@
+'''
+times every db.Database query against generated databases at multiples of
+the production size and writes the timings to a json report, so runs on
+different commits can be compared
+
+    python -m benchmarks.bench_db [--scales 1,10,100] [--output bench_db.json]
+'''
+import os
+import json
+import time
+import random
+import sqlite3
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+
+from db import Database
+from quizcalendar import QuizCalendar
+from benchmarks.dbgen import generate_database, get_size
+
+
+REPEAT = 20
+
+
+def get_queries(db, seed=0):
+    # (name, fn) for everything worth timing, with realistic arguments
+    random.seed(seed)
+    db._execute('SELECT id, ts FROM quizzes;')
+    quizzes = db.cursor.fetchall()
+    db._execute('SELECT id, name FROM users;')
+    users = db.cursor.fetchall()
+
+    def find_quiz():
+        quiz_id, quiz_ts = random.choice(quizzes)
+        return db.find_quiz(quiz_ts + 60 * 60, random.random() < 0.5, False, random.randint(0, 1))
+
+    calendar = QuizCalendar()
+    calendar.load(db.get_quiz_timestamps())
+
+    def find_quiz_in_calendar():
+        quiz_id, quiz_ts = random.choice(quizzes)
+        return calendar.find_quiz_id(quiz_ts + 60 * 60, random.random() < 0.5, False, random.randint(0, 1))
+
+    def find_quiz_score():
+        return db.find_quiz_score(random.choice(users)[0], random.choice(quizzes)[0])
+
+    def find_recent_scores_by_user_id():
+        return db.find_recent_scores_by_user_id(random.choice(users)[0], 10)
+
+    def find_users_by_name_substring():
+        return db.find_users_by_name_substring(random.choice(users)[1])
+
+    queries = []
+    for engine in ('stats', 'sql', 'python'):
+        queries.append((f'get_leaderboard[{engine}]', lambda engine=engine: db.get_leaderboard(False, engine)))
+        queries.append((f'get_leaderboard_all_time[{engine}]', lambda engine=engine: db.get_leaderboard(True, engine)))
+    queries += [
+        ('get_quiz_stats', lambda: db.get_quiz_stats(3)),
+        ('get_quiz_stats_from_scores', db.get_quiz_stats_from_scores),
+        ('find_quiz', find_quiz),
+        ('find_quiz[calendar]', find_quiz_in_calendar),
+        ('find_quiz_score', find_quiz_score),
+        ('find_recent_scores_by_user_id', find_recent_scores_by_user_id),
+        ('find_users_by_name_substring', find_users_by_name_substring),
+    ]
+    return queries
+
+
+def time_query(fn, repeat):
+    # one untimed call to warm the page and statement caches
+    fn()
+    timings = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - t0)
+    return {
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'mean': statistics.mean(timings),
+        'max': max(timings),
+        'repeat': repeat
+    }
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return None
+
+
+def run(scales, repeat, data_dir):
+    report = {
+        'commit': get_commit(),
+        'time': time.time(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'scales': {}
+    }
+    for scale in scales:
+        size = get_size(scale)
+        file_name = os.path.join(data_dir, f'bench-{scale}x.db')
+        print(f'generating {scale}x database ({size})...')
+        t0 = time.perf_counter()
+        counts = generate_database(file_name, **size)
+        print(f'generated {counts} in {time.perf_counter() - t0:.1f}s')
+        results = {}
+        with Database(file_name) as db:
+            for name, fn in get_queries(db):
+                results[name] = time_query(fn, repeat)
+                print(f'  {scale:>5}x {name:<36} {1000 * results[name]["median"]:10.3f}ms median')
+        report['scales'][str(scale)] = {
+            'size': size,
+            'counts': counts,
+            'queries': results
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark db.Database queries')
+    parser.add_argument('--scales', default='1,10,100', help='comma separated multiples of the production size')
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    parser.add_argument('--output', default='bench_db.json', help='where to write the json report')
+    parser.add_argument('--data-dir', default=None, help='keep the generated databases here')
+    args = parser.parse_args()
+
+    scales = [float(scale) if '.' in scale else int(scale) for scale in args.scales.split(',')]
+    if args.data_dir:
+        os.makedirs(args.data_dir, exist_ok=True)
+        report = run(scales, args.repeat, args.data_dir)
+    else:
+        with tempfile.TemporaryDirectory() as data_dir:
+            report = run(scales, args.repeat, data_dir)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'wrote {args.output}')
+
+
+if __name__ == '__main__':
+    main()
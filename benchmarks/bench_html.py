@@ -0,0 +1,74 @@
+'''
+checks every htmlextract backend against BeautifulSoup on the saved stuff
+pages, then compares their parse time and peak memory
+
+    python -m benchmarks.bench_html [repeat]
+
+peak memory is what tracemalloc sees, i.e. python allocations. lxml builds
+its tree in C (libxml2), so its figure only covers the python side
+'''
+import os
+import sys
+import timeit
+import tracemalloc
+
+import htmlextract
+
+
+DATA_DIR            = os.path.join(os.path.dirname(__file__), 'data')
+LIST_FILE_NAME      = os.path.join(DATA_DIR, 'stuff_quiz_list.html')
+DETAIL_FILE_NAME    = os.path.join(DATA_DIR, 'stuff_quiz_detail.html')
+REPEAT = 50
+
+
+def load_page(file_name):
+    with open(file_name, 'rb') as f:
+        return f.read()
+
+
+def get_cases():
+    # (name, method name, page)
+    return [
+        ('quiz links', 'extract_quiz_links', load_page(LIST_FILE_NAME)),
+        ('byline date', 'extract_byline_date', load_page(DETAIL_FILE_NAME))
+    ]
+
+
+def check_backends(cases):
+    mismatches = 0
+    for case_name, method_name, page in cases:
+        expected = getattr(htmlextract.EXTRACTORS['bs4'], method_name)(page)
+        for backend, extractor in htmlextract.EXTRACTORS.items():
+            actual = getattr(extractor, method_name)(page)
+            if actual != expected:
+                print(f'MISMATCH {backend} {case_name}: expected {expected!r}, got {actual!r}')
+                mismatches += 1
+    return mismatches
+
+
+def get_peak_memory(fn):
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else REPEAT
+    cases = get_cases()
+    mismatches = check_backends(cases)
+    print(f'{mismatches} mismatches across {len(htmlextract.EXTRACTORS)} backends')
+    for case_name, method_name, page in cases:
+        print(f'{case_name} ({len(page) / 1024:.0f}KiB page):')
+        for backend, extractor in sorted(htmlextract.EXTRACTORS.items()):
+            fn = lambda: getattr(extractor, method_name)(page)
+            seconds = min(timeit.repeat(fn, number=1, repeat=repeat))
+            peak_bytes = get_peak_memory(fn)
+            print(f'  {backend:<8} {1000 * seconds:8.2f}ms  {peak_bytes / 1024:8.0f}KiB peak')
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
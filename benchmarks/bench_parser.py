@@ -0,0 +1,60 @@
+'''
+checks scoreparser against the legacy parser on the message corpus, then
+times both
+
+    python -m benchmarks.bench_parser [repeat]
+'''
+import os
+import sys
+import json
+import timeit
+import datetime
+
+import scoreparser
+from benchmarks import legacy_parser
+
+
+CORPUS_FILE_NAME = os.path.join(os.path.dirname(__file__), 'data', 'score_messages.jsonl')
+REPEAT = 200
+
+
+def load_corpus(file_name=CORPUS_FILE_NAME):
+    with open(file_name) as f:
+        return [json.loads(line)['text'] for line in f if line.strip()]
+
+
+def check_corpus(messages):
+    # the legacy parser always uses today's date, so compare against that
+    today = datetime.date.today()
+    mismatches = 0
+    for text in messages:
+        expected = legacy_parser.parse_text_for_scores(text)
+        actual = scoreparser.parse_text_for_scores(text, today)
+        if actual != expected:
+            print(f'MISMATCH {text!r}: expected {expected}, got {actual}')
+            mismatches += 1
+    return mismatches
+
+
+def time_parser(parse_fn, messages, repeat):
+    def run():
+        for text in messages:
+            parse_fn(text)
+    # best of 5, per message
+    return min(timeit.repeat(run, number=repeat, repeat=5)) / (repeat * len(messages))
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else REPEAT
+    messages = load_corpus()
+    mismatches = check_corpus(messages)
+    print(f'{len(messages)} messages, {mismatches} mismatches')
+    legacy_seconds = time_parser(legacy_parser.parse_text_for_scores, messages, repeat)
+    seconds = time_parser(scoreparser.parse_text_for_scores, messages, repeat)
+    print(f'legacy parser: {legacy_seconds * 1e6:.2f}us per message')
+    print(f'scoreparser:   {seconds * 1e6:.2f}us per message ({legacy_seconds / seconds:.2f}x)')
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+'''
+generates synthetic quiz-scorer databases for benchmarking
+
+quizzes are published twice a day (morning and afternoon) on the
+QUIZ_DAYS_OF_WEEK, going back from today, and each user posts a score for
+a share of them, usually a little after the quiz came out
+
+    python -m benchmarks.dbgen <database> [scale]
+'''
+import os
+import sys
+import math
+import random
+import datetime
+
+from db import Database, CONNECTION_POOL
+from migrations import QUIZ_DATE_SQL, QUIZ_IS_AM_SQL
+from scoreparser import QUIZ_DAYS_OF_WEEK
+
+
+# roughly what the bot has seen so far
+PRODUCTION_USERS            = 25
+PRODUCTION_DAYS             = 2 * 365
+PRODUCTION_PARTICIPATION    = 0.6
+QUIZ_TIMES = (
+    datetime.time(5, 0),
+    datetime.time(15, 0)
+)
+
+
+def get_size(scale):
+    # scale is applied to the number of scores, split evenly between
+    # having more users and having more history
+    factor = math.sqrt(scale)
+    return {
+        'users': int(round(PRODUCTION_USERS * factor)),
+        'days': int(round(PRODUCTION_DAYS * factor)),
+        'participation': PRODUCTION_PARTICIPATION
+    }
+
+
+def generate_database(file_name, users, days, participation, seed=0):
+    random.seed(seed)
+    # don't keep using a pooled connection to a file we're about to replace
+    CONNECTION_POOL.close()
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(file_name + suffix):
+            os.remove(file_name + suffix)
+
+    user_rows = [(f'U{index:06d}', f'user{index}') for index in range(users)]
+    # some users are keener than others
+    user_participation = [min(1.0, random.uniform(0.3, 1.7) * participation) for _ in user_rows]
+
+    quiz_rows = []
+    today = datetime.date.today()
+    for days_ago in range(days, 0, -1):
+        quiz_date = today - datetime.timedelta(days=days_ago)
+        if quiz_date.weekday() not in QUIZ_DAYS_OF_WEEK:
+            continue
+        for quiz_time in QUIZ_TIMES:
+            quiz_id = str(100000 + len(quiz_rows))
+            quiz_ts = datetime.datetime.combine(quiz_date, quiz_time).timestamp()
+            quiz_rows.append((
+                quiz_id,
+                f'Quiz: {quiz_date:%A %B %d} {"morning" if quiz_time.hour < 12 else "afternoon"} trivia challenge',
+                f'https://www.stuff.co.nz/national/quizzes/{quiz_id}/quiz',
+                quiz_ts,
+                quiz_ts,
+                quiz_ts
+            ))
+
+    score_rows = []
+    for quiz_id, _, _, quiz_ts, _, _ in quiz_rows:
+        for (user_id, _), chance in zip(user_rows, user_participation):
+            if random.random() >= chance:
+                continue
+            # mostly within a few hours, sometimes back-posted days later
+            if random.random() < 0.05:
+                delay = random.uniform(1, 6) * 24 * 60 * 60
+            else:
+                delay = random.expovariate(1 / (2 * 60 * 60))
+            score = max(0, min(15, int(round(random.gauss(10, 2.5)))))
+            score_rows.append((user_id, quiz_id, 'C000000', score, quiz_ts + delay))
+    # scores are added in the order they are posted
+    score_rows.sort(key=lambda row: row[4])
+
+    with Database(file_name) as db:
+        db.initialize()
+        db.cursor.executemany(
+            'INSERT INTO users (id, name) VALUES (?, ?);',
+            user_rows
+        )
+        db.cursor.executemany(
+            'INSERT INTO quizzes (id, name, url, ts, quiz_date, is_am) '
+            f'VALUES (?, ?, ?, ?, {QUIZ_DATE_SQL.format(ts="?")}, {QUIZ_IS_AM_SQL.format(ts="?")});',
+            quiz_rows
+        )
+        db.cursor.executemany(
+            'INSERT INTO scores (user_id, quiz_id, channel_id, score, ts) VALUES (?, ?, ?, ?, ?);',
+            score_rows
+        )
+        db.rebuild_stats()
+        db.cursor.execute('ANALYZE;')
+    return {
+        'users': len(user_rows),
+        'quizzes': len(quiz_rows),
+        'scores': len(score_rows)
+    }
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3):
+        print(f'usage: {sys.argv[0]} <database> [scale]')
+        sys.exit(1)
+    scale = float(sys.argv[2]) if len(sys.argv) == 3 else 1
+    counts = generate_database(sys.argv[1], **get_size(scale))
+    print(f'generated {sys.argv[1]}: {counts}')
@@ -0,0 +1,80 @@
+'''
+the score parser as it was before scoreparser.py, kept as the reference
+its output is checked against and the baseline it is timed against
+'''
+import re
+import datetime
+
+from scoreparser import WEEK_DAYS
+
+
+def strip_emojis(line):
+    return re.sub(r':[0-9A-Za-z._-]+:', '', line)
+
+
+def parse_text_for_marker(text, markers):
+    for marker in markers:
+        if marker in text:
+            return True
+    return False
+
+
+def parse_text_for_morning(text):
+    return parse_text_for_marker(text.lower(), ('am', 'a.m', 'morning'))
+
+
+def parse_text_for_afternoon(text):
+    return parse_text_for_marker(text.lower(), ('pm', 'p.m', 'afternoon'))
+
+
+def parse_text_for_yesterday(text):
+    return parse_text_for_marker(text.lower(), ('yesterday',))
+
+
+def parse_text_for_days_ago(text):
+    text_lower = text.lower()
+    if 'today' in text_lower:
+        return 0
+    if 'yesterday' in text_lower:
+        return 1
+    # what day is today?
+    today_day = datetime.date.today().weekday()
+    # is a weekday name provided?
+    for day, names in enumerate(WEEK_DAYS):
+        if parse_text_for_marker(text_lower, names):
+            return (today_day - day) % 7
+    # assume today
+    return 0
+
+
+def parse_text_for_scores(text):
+    '''
+    returns scores in the given text as a list of
+    [
+        (score, is_am, is_pm, days_ago)
+        ...
+    ]
+    '''
+    parsed_scores = []
+    for line in text.split('\n'):
+        try:
+            text_scores = re.findall(r'([0-9]{1,2})/15', line)
+        except Exception as e:
+            print(f'exception parsing text for score: {e} ({text})')
+        else:
+            if not text_scores:
+                continue
+            # use the first score on this line
+            score = int(text_scores[0])
+            if score < 0:
+                continue
+            if score > 15:
+                continue
+            text_line = strip_emojis(line)
+            parsed_scores.append((
+                score,
+                parse_text_for_morning(text_line),
+                parse_text_for_afternoon(text_line),
+                parse_text_for_days_ago(text_line)
+            ))
+    return parsed_scores
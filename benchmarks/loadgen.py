@@ -0,0 +1,460 @@
+'''
+end-to-end load generator: replays rtm message events into the app's message
+handler at a controlled rate, against a generated database and a fake slack
+
+slack is either an in-process fake web client or (--http-stub) a real
+slack.WebClient talking to a local stub of the web api. both record every
+call and can add latency. the report has the throughput, latency
+percentiles per kind of event, slack call timings and database writer
+contention
+
+    python -m benchmarks.loadgen [--rate 50] [--events 2000] [--runtime sync|async]
+    python -m benchmarks.loadgen --payloads recorded.jsonl
+'''
+import os
+import json
+import time
+import random
+import asyncio
+import argparse
+import datetime
+import tempfile
+import threading
+import contextlib
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Pool
+from urllib.parse import parse_qsl, urlsplit
+
+import slack
+
+import app
+from db import Database, CONNECTION_POOL
+from cache import SingleFlight
+from writer import DatabaseWriter
+from dispatcher import RateLimiter, SlackDispatcher
+from benchmarks.dbgen import QUIZ_TIMES, generate_database, get_size
+
+
+QUIZ_CHANNEL_ID     = 'C000000'
+OTHER_CHANNEL_ID    = 'C000001'
+POSTER_USERS        = 200
+SLACK_LATENCY_MS    = 20
+UNLIMITED           = (1e9, 1e9)
+# share of each kind of synthetic event
+EVENT_MIX = {
+    'scores': 60,
+    'chatter': 20,
+    'other-channel': 10,
+    '!leaderboard': 4,
+    '!leaderboard all-time': 2,
+    '!quizstats': 2,
+    '!last10': 2
+}
+SCORE_MARKERS = ('', 'am', 'pm', 'morning', 'afternoon', 'yesterday am', 'yesterday pm')
+CHATTER = ('ha', 'that last question was rough', 'who knew', ':sob:', 'brb')
+# lines printed by the app that point at database contention or failures
+LOG_PATTERNS = {
+    'database-locked': 'database is locked',
+    'write-failed': 'could not write to database',
+    'score-rejected': 'could not be added',
+    'exception': 'exception'
+}
+
+
+class FakeResponse():
+    '''
+    the bits of slack.web.slack_response.SlackResponse the app uses
+    '''
+    def __init__(self, data):
+        self.data = data
+        self.status_code = 200
+
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+
+class FakeSlack():
+    '''
+    answers slack web api methods from a fixed set of users and channels,
+    recording (method, seconds) for every call
+    '''
+    def __init__(self, users, channels, latency_seconds=0):
+        # id -> display name
+        self.users = users
+        self.channels = channels
+        self.latency_seconds = latency_seconds
+        self.lock = threading.Lock()
+        self.calls = []
+
+
+    def handle(self, method, args):
+        t0 = time.perf_counter()
+        if self.latency_seconds:
+            time.sleep(random.expovariate(1 / self.latency_seconds))
+        data = self.get_data(method, args)
+        with self.lock:
+            self.calls.append((method, time.perf_counter() - t0))
+        return data
+
+
+    def get_data(self, method, args):
+        if method == 'users.list':
+            members = [{'id': user_id, 'profile': {'display_name': name}} for user_id, name in self.users.items()]
+            return {'ok': True, 'members': members, 'response_metadata': {'next_cursor': ''}}
+        if method == 'conversations.list':
+            channels = [{'id': channel_id, 'name': name} for channel_id, name in self.channels.items()]
+            return {'ok': True, 'channels': channels, 'response_metadata': {'next_cursor': ''}}
+        if method == 'users.info':
+            user_id = args.get('user')
+            return {'ok': True, 'user': {'id': user_id, 'profile': {'display_name': self.users.get(user_id, user_id)}}}
+        if method in ('channels.info', 'groups.info'):
+            channel_id = args.get('channel')
+            channel = {'id': channel_id, 'name': self.channels.get(channel_id, channel_id)}
+            return {'ok': True, 'group' if method == 'groups.info' else 'channel': channel}
+        if method == 'chat.postMessage':
+            return {'ok': True, 'channel': args.get('channel'), 'ts': f'{time.time():.6f}'}
+        return {'ok': True}
+
+
+    def get_stats(self):
+        with self.lock:
+            calls = list(self.calls)
+        timings = defaultdict(list)
+        for method, seconds in calls:
+            timings[method].append(seconds)
+        return {method: get_latency_stats(seconds) for method, seconds in sorted(timings.items())}
+
+
+class FakeWebClient():
+    '''
+    stands in for slack.WebClient: web_client.chat_postMessage(...) is
+    answered by the fake slack as chat.postMessage
+    '''
+    def __init__(self, fake_slack):
+        self.fake_slack = fake_slack
+
+
+    def __getattr__(self, name):
+        method = name.replace('_', '.')
+
+        def call(**kwargs):
+            return FakeResponse(self.fake_slack.handle(method, kwargs))
+        call.__name__ = name
+        return call
+
+
+def get_stub_handler(fake_slack):
+    class SlackStubHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            url = urlsplit(self.path)
+            method = url.path.rsplit('/', 1)[-1]
+            args = dict(parse_qsl(url.query))
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length).decode() if length else ''
+            if 'json' in (self.headers.get('Content-Type') or ''):
+                args.update(json.loads(body or '{}'))
+            else:
+                args.update(parse_qsl(body))
+            response = json.dumps(fake_slack.handle(method, args)).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+
+
+        do_GET = do_POST
+
+
+        def log_message(self, format, *args):
+            pass
+
+    return SlackStubHandler
+
+
+def start_slack_stub(fake_slack):
+    # returns the server and the base url for web clients
+    server = ThreadingHTTPServer(('127.0.0.1', 0), get_stub_handler(fake_slack))
+    threading.Thread(target=server.serve_forever, name='slack-stub', daemon=True).start()
+    host, port = server.server_address
+    return server, f'http://{host}:{port}/api/'
+
+
+class LogCounter():
+    '''
+    stdout replacement that counts the app's log lines by LOG_PATTERNS
+    '''
+    def __init__(self):
+        self.counts = defaultdict(int)
+        self.lock = threading.Lock()
+
+
+    def write(self, text):
+        text = text.lower()
+        with self.lock:
+            for name, pattern in LOG_PATTERNS.items():
+                if pattern in text:
+                    self.counts[name] += 1
+        return len(text)
+
+
+    def flush(self):
+        pass
+
+
+def get_synthetic_events(count, poster_ids, user_names, mix=EVENT_MIX, seed=0):
+    # (kind, rtm message data) with the ts filled in when it's replayed
+    random.seed(seed)
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    events = []
+    for kind in random.choices(kinds, weights, k=count):
+        channel_id = QUIZ_CHANNEL_ID
+        user_id = random.choice(poster_ids)
+        if kind == 'scores':
+            score = max(0, min(15, int(round(random.gauss(10, 2.5)))))
+            text = f'{score}/15 {random.choice(SCORE_MARKERS)}'.strip()
+        elif kind == 'chatter':
+            text = random.choice(CHATTER)
+        elif kind == 'other-channel':
+            channel_id = OTHER_CHANNEL_ID
+            text = f'{random.randint(0, 15)}/15'
+        elif kind == '!last10':
+            text = f'!last10 {random.choice(user_names)}'
+        else:
+            text = kind
+        events.append((kind, {'channel': channel_id, 'user': user_id, 'text': text}))
+    return events
+
+
+def load_payloads(file_name):
+    # one rtm message event (the payload's data) per line
+    events = []
+    with open(file_name) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            data = json.loads(line)
+            command, handler = app.COMMAND_ROUTER.match(data.get('text') or '')
+            events.append((command or 'message', data))
+    return events
+
+
+def get_latency_stats(timings):
+    timings = sorted(timings)
+
+    def percentile(p):
+        # nearest rank
+        return timings[max(0, min(len(timings) - 1, int(round(p / 100 * len(timings))) - 1))]
+
+    return {
+        'count': len(timings),
+        'p50': percentile(50),
+        'p95': percentile(95),
+        'p99': percentile(99),
+        'max': timings[-1]
+    }
+
+
+def add_todays_quizzes(file_name):
+    # dbgen stops at yesterday, scores need something to be for
+    today = datetime.date.today()
+    with Database(file_name) as db:
+        for quiz_time in QUIZ_TIMES:
+            quiz_ts = datetime.datetime.combine(today, quiz_time).timestamp()
+            quiz_id = f'loadgen-{today:%Y%m%d}-{quiz_time.hour}'
+            db.add_quiz(quiz_id, f'Quiz: {today:%A %B %d} trivia challenge', f'https://example.com/{quiz_id}', quiz_ts)
+
+
+def set_up_app(file_name, web_client, pool_size, runtime, rate_limiter):
+    # what app.__main__ does, minus slack
+    app.DATABASE_NAME = file_name
+    app.RUNTIME = runtime
+    app.WEB_CLIENT = web_client
+    app.RESULT_CACHE.clear()
+    app.CHANNEL_IS_QUIZ_CHANNEL.clear()
+    app.load_quiz_calendar()
+    # forked after DATABASE_NAME is set, so the workers read the right file,
+    # and without our connections
+    CONNECTION_POOL.close()
+    app.PROCESS_POOL = Pool(pool_size)
+    app.COMPUTATIONS = SingleFlight(pool_size, app.COMPUTE_QUEUE_LENGTH)
+    app.DATABASE_WRITER = DatabaseWriter(file_name)
+    app.DATABASE_WRITER.start()
+    app.SLACK_DISPATCHER = SlackDispatcher(web_client, rate_limiter=rate_limiter)
+    app.SLACK_DISPATCHER.start()
+    app.warm_up_directory(web_client)
+    app.resolve_quiz_channel()
+    # let the directory's writes land, then count from zero
+    app.DATABASE_WRITER.submit('get_schema_version').result()
+    app.DATABASE_WRITER.batch_count = 0
+    app.DATABASE_WRITER.write_count = 0
+    app.DATABASE_WRITER.queue_seconds = 0.0
+    app.DATABASE_WRITER.max_queue_depth = 0
+
+
+def tear_down_app():
+    app.SLACK_DISPATCHER.stop()
+    app.PROCESS_POOL.close()
+    app.PROCESS_POOL.join()
+    app.DATABASE_WRITER.stop()
+    app.DATABASE_WRITER.join()
+    CONNECTION_POOL.close()
+
+
+async def replay(events, rate):
+    '''
+    sends events to the app's message handler at `rate` per second, one at a
+    time or overlapping depending on app.RUNTIME, like the rtm client.
+    latency is measured from when an event was due, so time spent queued
+    behind slow events counts. slack calls are queued for the dispatcher,
+    so they're not part of it
+    '''
+    latencies = defaultdict(list)
+    tasks = []
+
+    async def handle(kind, data, due_at):
+        await app.handle_message_event(data)
+        latencies[kind].append(time.perf_counter() - due_at)
+
+    started_at = time.perf_counter()
+    for index, (kind, data) in enumerate(events):
+        due_at = started_at + index / rate
+        delay = due_at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        # the ts slack would have given the message
+        data = dict(data, ts=f'{time.time():.6f}')
+        if app.RUNTIME == 'async':
+            tasks.append(asyncio.ensure_future(handle(kind, data, due_at)))
+        else:
+            await handle(kind, data, due_at)
+    await asyncio.gather(*tasks)
+    return latencies, time.perf_counter() - started_at
+
+
+def run(args, data_dir):
+    file_name = os.path.join(data_dir, f'loadgen-{args.scale}x.db')
+    print(f'generating {args.scale}x database...')
+    counts = generate_database(file_name, **get_size(args.scale))
+    add_todays_quizzes(file_name)
+    CONNECTION_POOL.close()
+
+    with Database(file_name) as db:
+        user_names = dict(db.get_users())
+    poster_ids = [f'U9{index:05d}' for index in range(args.users)]
+    slack_users = dict(user_names, **{user_id: f'poster{index}' for index, user_id in enumerate(poster_ids)})
+    slack_channels = {QUIZ_CHANNEL_ID: app.QUIZ_CHANNEL.lstrip('#'), OTHER_CHANNEL_ID: 'general'}
+    fake_slack = FakeSlack(slack_users, slack_channels, args.slack_latency_ms / 1000)
+    server = None
+    if args.http_stub:
+        server, base_url = start_slack_stub(fake_slack)
+        web_client = slack.WebClient(token='xoxb-loadgen', base_url=base_url)
+    else:
+        web_client = FakeWebClient(fake_slack)
+    # the fake slack doesn't rate limit, so by default neither does the app
+    if args.rate_limits:
+        rate_limiter = RateLimiter()
+    else:
+        rate_limiter = RateLimiter(rate_limits={}, default_rate_limit=UNLIMITED)
+
+    if args.payloads:
+        events = load_payloads(args.payloads)
+    else:
+        events = get_synthetic_events(args.events, poster_ids, list(user_names.values()) + ['poster1'], seed=args.seed)
+
+    log_counter = LogCounter()
+    with contextlib.redirect_stdout(log_counter):
+        set_up_app(file_name, web_client, args.pool_size, args.runtime, rate_limiter)
+    fake_slack.calls.clear()
+    print(f'replaying {len(events)} events at {args.rate}/s with the {args.runtime} runtime...')
+    log_counter = LogCounter()
+    try:
+        with contextlib.redirect_stdout(log_counter):
+            latencies, seconds = asyncio.run(replay(events, args.rate))
+            writer_stats = app.DATABASE_WRITER.get_stats()
+            computations = {'computed': app.COMPUTATIONS.computed, 'coalesced': app.COMPUTATIONS.coalesced}
+            dispatcher = app.SLACK_DISPATCHER
+    finally:
+        # waits for the slack dispatcher to drain
+        with contextlib.redirect_stdout(log_counter):
+            tear_down_app()
+        if server:
+            server.shutdown()
+
+    return {
+        'scale': args.scale,
+        'counts': counts,
+        'rate': args.rate,
+        'runtime': args.runtime,
+        'http_stub': args.http_stub,
+        'slack_latency_ms': args.slack_latency_ms,
+        'events': len(events),
+        'seconds': seconds,
+        'throughput': len(events) / seconds,
+        'latency': {kind: get_latency_stats(timings) for kind, timings in sorted(latencies.items())},
+        'slack': fake_slack.get_stats(),
+        'writer': writer_stats,
+        'dispatcher': dispatcher.get_stats(),
+        'computations': computations,
+        'log': dict(log_counter.counts)
+    }
+
+
+def print_report(report):
+    print(f'{report["events"]} events in {report["seconds"]:.1f}s: {report["throughput"]:.1f} events/s '
+        f'(target {report["rate"]}/s)')
+    print(f'{"event":<24} {"count":>6} {"p50":>9} {"p95":>9} {"p99":>9} {"max":>9}')
+    for name, section in (('', report['latency']), ('slack ', report['slack'])):
+        for kind, stats in section.items():
+            print(f'{name + kind:<24} {stats["count"]:>6} ' + ' '.join(
+                f'{1000 * stats[key]:>7.1f}ms' for key in ('p50', 'p95', 'p99', 'max')
+            ))
+    writer = report['writer']
+    print(f'db-writer: {writer["writes"]} writes in {writer["batches"]} batches '
+        f'({writer["average_batch_size"]:.1f} per batch), '
+        f'{1000 * writer["average_queue_seconds"]:.1f}ms average queue wait, '
+        f'max queue depth {writer["max_queue_depth"]}')
+    print(f'slack-dispatcher: {report["dispatcher"]}')
+    print(f'leaderboard/quizstats computations: {report["computations"]}')
+    print(f'log lines: {report["log"]}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='replay message events into the app against a fake slack')
+    parser.add_argument('--rate', type=float, default=50, help='events per second')
+    parser.add_argument('--events', type=int, default=2000, help='number of synthetic events')
+    parser.add_argument('--payloads', default=None, help='jsonl of recorded rtm message events to replay instead')
+    parser.add_argument('--runtime', choices=('sync', 'async'), default=app.RUNTIME, help='how the app handles events')
+    parser.add_argument('--scale', type=float, default=1, help='database size, as a multiple of production')
+    parser.add_argument('--users', type=int, default=POSTER_USERS, help='new users posting scores')
+    parser.add_argument('--pool-size', type=int, default=app.PROCESS_POOL_SIZE, help='leaderboard/quizstats processes')
+    parser.add_argument('--slack-latency-ms', type=float, default=SLACK_LATENCY_MS, help='mean slack api latency')
+    parser.add_argument('--rate-limits', action='store_true', help="pace slack calls by slack's rate limit tiers")
+    parser.add_argument('--http-stub', action='store_true', help='use slack.WebClient against a local api stub')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='also write the report as json here')
+    parser.add_argument('--data-dir', default=None, help='keep the generated database here')
+    args = parser.parse_args()
+
+    if args.data_dir:
+        os.makedirs(args.data_dir, exist_ok=True)
+        report = run(args, args.data_dir)
+    else:
+        with tempfile.TemporaryDirectory() as data_dir:
+            report = run(args, data_dir)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'wrote {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+import time
+import asyncio
+import threading
+from collections import OrderedDict, deque
+
+
+CACHE_MAX_ENTRIES = 32
+
+
+class ResultCache():
+    '''
+    a small LRU cache of query results stamped with the data generation
+    they were computed from (see db.get_data_generation)
+
+    an entry is only returned for the generation it was stored with, so any
+    write makes the cached results miss. entries can also expire, for
+    results that change with the time of day, not just with writes
+    '''
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, kind, generation):
+        key = (kind, generation)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at is None or time.monotonic() < expires_at:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+
+    def put(self, kind, generation, value, ttl_seconds=None):
+        key = (kind, generation)
+        expires_at = None if ttl_seconds is None else time.monotonic() + ttl_seconds
+        with self.lock:
+            self.entries[key] = (expires_at, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class SingleFlight():
+    '''
+    coalesces concurrent calls for the same key into one computation, whose
+    result (or exception) every caller gets
+
+    it lives on one event loop: fn is a coroutine function and callers
+    await do(), so nobody holds a thread while they wait. at most
+    max_running computations run at once and up to max_waiting more wait
+    their turn, past that a new computation raises QueueFullError. callers
+    can always join a computation that's already in flight
+    '''
+    def __init__(self, max_running, max_waiting):
+        self.max_running = max_running
+        self.max_admitted = max_running + max_waiting
+        # key -> task of the running (or waiting) computation
+        self.in_flight = {}
+        self.running = 0
+        # futures of computations waiting for a turn, first come first served
+        self.turns = deque()
+        self.computed = 0
+        self.coalesced = 0
+
+
+    async def do(self, key, fn, *args):
+        task = self.in_flight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            if len(self.in_flight) >= self.max_admitted:
+                raise QueueFullError(f'{len(self.in_flight)} computations are already running or waiting')
+            self.computed += 1
+            task = self.in_flight[key] = asyncio.ensure_future(self.run(key, fn, *args))
+        # one caller going away doesn't cancel it for the rest
+        return await asyncio.shield(task)
+
+
+    async def run(self, key, fn, *args):
+        try:
+            if self.running < self.max_running:
+                self.running += 1
+            else:
+                turn = asyncio.get_running_loop().create_future()
+                self.turns.append(turn)
+                # the computation finishing hands its turn over
+                await turn
+            try:
+                return await fn(*args)
+            finally:
+                self.end_turn()
+        finally:
+            del self.in_flight[key]
+
+
+    def end_turn(self):
+        while self.turns:
+            turn = self.turns.popleft()
+            if not turn.done():
+                turn.set_result(None)
+                return
+        self.running -= 1
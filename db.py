@@ -1,42 +1,257 @@
+import os
+import sys
+import json
 import sqlite3
+import math
+import time
 import datetime
+import threading
+
+from metrics import METRICS, timed_methods
+from migrations import MIGRATIONS, QUIZ_DATE_SQL, QUIZ_IS_AM_SQL
+from stats import (
+    RECENT_SCORES_LENGTH,
+    add_quiz_score,
+    add_user_score,
+    get_recent_score_key,
+    rebuild_quiz_stats,
+    rebuild_user_stats
+)
+
+
+# the (non all-time) leaderboard only counts scores this recent
+LEADERBOARD_WINDOW_DAYS = 28
+# where get_leaderboard gets its numbers from:
+#   stats:  the incrementally maintained user_stats table
+#   sql:    window functions over the scores table
+#   python: every score row, aggregated in python
+LEADERBOARD_ENGINE = os.environ.get('LEADERBOARD_ENGINE', 'stats')
+
+# connection tuning, applied once per pooled connection
+BUSY_TIMEOUT_SECONDS    = 30
+CACHED_STATEMENTS       = 256
+CONNECTION_PRAGMAS = (
+    'PRAGMA journal_mode=WAL;',
+    'PRAGMA synchronous=NORMAL;',
+    # negative cache size is in KiB
+    'PRAGMA cache_size=-16384;',
+    'PRAGMA mmap_size=268435456;',
+    'PRAGMA temp_store=MEMORY;'
+)
+
+# print every statement sqlite runs, with its parameters filled in
+SQL_TRACE = os.environ.get('SQL_TRACE', '') == '1'
+# statements run through Database._execute that take longer than this are
+# logged, 0 turns it off. it's the time to the first row, which for the
+# sorting and grouping queries is nearly all of it
+SLOW_QUERY_SECONDS = float(os.environ.get('SLOW_QUERY_SECONDS', 0.1))
+
+
+class ConnectionPool():
+    '''
+    hands out one long-lived connection per (process, thread, database file)
+
+    sqlite connections can't be shared between threads (or survive a fork
+    into the process pool), so each thread lazily opens its own connection
+    and keeps it for the life of the thread
+    '''
+    def __init__(self):
+        self.local = threading.local()
+
+
+    def get(self, file_name):
+        connections = getattr(self.local, 'connections', None)
+        pid = os.getpid()
+        if connections is None or self.local.pid != pid:
+            # first use on this thread, or we are in a forked child and the
+            # inherited connections belong to the parent. those stay
+            # referenced, as dropping them would close the parent's handles
+            if connections is not None:
+                self.local.inherited = connections
+            connections = self.local.connections = {}
+            self.local.pid = pid
+        conn = connections.get(file_name)
+        if conn is None:
+            conn = self.connect(file_name)
+            connections[file_name] = conn
+        return conn
+
+
+    def connect(self, file_name):
+        conn = sqlite3.connect(
+            file_name,
+            timeout=BUSY_TIMEOUT_SECONDS,
+            cached_statements=CACHED_STATEMENTS
+        )
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        if SQL_TRACE:
+            conn.set_trace_callback(trace_sql)
+        return conn
+
+
+    def close(self):
+        # closes the calling thread's connections
+        connections = getattr(self.local, 'connections', None)
+        if connections is None or self.local.pid != os.getpid():
+            return
+        for conn in connections.values():
+            conn.close()
+        connections.clear()
+
+
+CONNECTION_POOL = ConnectionPool()
+
+
+def trace_sql(statement):
+    print(f'sql: {statement}')
+
+# bumped whenever a commit changes the data, so results computed from an
+# older generation can be thrown away. only counts this process's writes
+DATA_GENERATION = 0
+DATA_GENERATION_LOCK = threading.Lock()
+
+
+def get_data_generation():
+    return DATA_GENERATION
+
+
+def bump_data_generation():
+    global DATA_GENERATION
+    with DATA_GENERATION_LOCK:
+        DATA_GENERATION += 1
+
+
+def get_leaderboard_cutoff():
+    return datetime.datetime.now().timestamp() - LEADERBOARD_WINDOW_DAYS * 24 * 60 * 60
+
 
+def get_leaderboard_line(user_name, scores, total_quizzes, total_score):
+    # scores are newest first, only the first 11 are needed
+    recent_scores = scores[:10]
+    recent_1_11_scores = scores[1:11]
+    line = {
+        'name': user_name,
+        'scores': scores,
+        'total_quizzes': total_quizzes,
+        'average_score': total_score / total_quizzes,
+        'recent_quizzes': len(recent_scores),
+        'recent_average': sum(recent_scores) / len(recent_scores),
+        'recent_1_11_quizzes': len(recent_1_11_scores),
+        'recent_1_11_average': sum(recent_1_11_scores) / max(1, len(recent_1_11_scores))
+    }
+    # calculate difference
+    line['recent_difference'] = line['recent_average'] - line['recent_1_11_average']
+    return line
 
+
+def sort_leaderboard(users, user_ids, is_all_time):
+    if is_all_time:
+        sort_fn = lambda u: users[u]['average_score']
+    else:
+        sort_fn = lambda u: users[u]['recent_average']
+    leaderboard = []
+    for user in sorted(user_ids, key=sort_fn, reverse=True):
+        leaderboard.append(users[user])
+    return leaderboard
+
+
+DB_METHOD_SECONDS = METRICS.histogram('db_method_seconds', 'Time spent in db.Database methods', ('method',))
+SLOW_QUERIES = METRICS.counter('slow_queries_total', 'Statements slower than SLOW_QUERY_SECONDS')
+
+
+@timed_methods(DB_METHOD_SECONDS)
 class Database():
     def __init__(self, file_name):
         self.file_name = file_name
+        # called with (sql, params, seconds) after every _execute
+        self.on_execute = None
 
 
     def __enter__(self):
-        self.conn = sqlite3.connect(self.file_name)
+        # borrow this thread's connection, statements are cached per connection
+        self.conn = CONNECTION_POOL.get(self.file_name)
         self.cursor = self.conn.cursor()
+        self.total_changes = self.conn.total_changes
         return self
 
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.cursor.close()
-        self.conn.close()
+        # the block is one unit of work: any writes in it commit together, and
+        # the connection outlives the block so it can't be left mid-transaction.
+        # reads never open a transaction, so they never pay for a commit
+        if self.conn.in_transaction:
+            if exc_type is None:
+                self.commit()
+            else:
+                self.conn.rollback()
+
+
+    def commit(self):
+        self.conn.commit()
+        # let cached results know the data has changed
+        if self.conn.total_changes != self.total_changes:
+            self.total_changes = self.conn.total_changes
+            bump_data_generation()
 
 
     def _execute(self, sql, params=None):
         params = params or ()
+        t0 = time.perf_counter()
         self.cursor.execute(sql, params)
-        self.conn.commit()
+        seconds = time.perf_counter() - t0
+        if SLOW_QUERY_SECONDS and seconds >= SLOW_QUERY_SECONDS:
+            SLOW_QUERIES.inc()
+            print(f'slow query ({1000 * seconds:.1f}ms): {sql} {params}')
+        if self.on_execute:
+            self.on_execute(sql, params, seconds)
+
+
+    def explain_query(self, sql, params=()):
+        '''
+        returns sqlite's query plan for a statement as indented lines, e.g.
+        "SEARCH quizzes USING INDEX quizzes_quiz_date (quiz_date=? AND is_am=?)"
+        '''
+        self.cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        depths = {0: -1}
+        lines = []
+        for node_id, parent_id, _, detail in self.cursor.fetchall():
+            depths[node_id] = depths.get(parent_id, -1) + 1
+            lines.append('  ' * depths[node_id] + detail)
+        return lines
 
 
     def initialize(self):
         self._execute(
-            'CREATE TABLE IF NOT EXISTS channels (id string, name string);'
-        )
-        self._execute(
-            'CREATE TABLE IF NOT EXISTS users (id string, name string);'
-        )
-        self._execute(
-            'CREATE TABLE IF NOT EXISTS scores (user_id string, quiz_id string, channel_id string, score integer, ts string);'
+            'CREATE TABLE IF NOT EXISTS schema_version (version integer NOT NULL);'
         )
+        current_version = self.get_schema_version()
+        for version, migration in enumerate(MIGRATIONS, start=1):
+            if version <= current_version:
+                continue
+            print(f'migrating database to version {version} ({migration.__name__})')
+            # take the write lock up front, the whole step commits or nothing does
+            self.cursor.execute('BEGIN IMMEDIATE;')
+            try:
+                migration(self.cursor)
+                self.cursor.execute('DELETE FROM schema_version;')
+                self.cursor.execute(
+                    'INSERT INTO schema_version (version) VALUES (?);',
+                    (version,)
+                )
+                self.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+
+
+    def get_schema_version(self):
         self._execute(
-            'CREATE TABLE IF NOT EXISTS quizzes (id string, name string, url string, ts string);'
+            'SELECT MAX(version) FROM schema_version;'
         )
+        rows = self.cursor.fetchall()
+        return rows[0][0] or 0
 
 
     def get_channel_name_by_id(self, channel_id):
@@ -52,7 +267,22 @@ class Database():
 
     def create_channel(self, channel_id, channel_name):
         self._execute(
-            'INSERT INTO channels (id, name) VALUES (?, ?);',
+            'INSERT OR IGNORE INTO channels (id, name) VALUES (?, ?);',
+            (channel_id, channel_name)
+        )
+
+
+    def get_channels(self):
+        self._execute(
+            'SELECT id, name FROM channels;'
+        )
+        return self.cursor.fetchall()
+
+
+    def save_channel(self, channel_id, channel_name):
+        self._execute(
+            'INSERT INTO channels (id, name) VALUES (?, ?) '
+            'ON CONFLICT (id) DO UPDATE SET name = excluded.name;',
             (channel_id, channel_name)
         )
 
@@ -81,7 +311,22 @@ class Database():
 
     def create_user(self, user_id, user_name):
         self._execute(
-            'INSERT INTO users (id, name) VALUES (?, ?);',
+            'INSERT OR IGNORE INTO users (id, name) VALUES (?, ?);',
+            (user_id, user_name)
+        )
+
+
+    def get_users(self):
+        self._execute(
+            'SELECT id, name FROM users;'
+        )
+        return self.cursor.fetchall()
+
+
+    def save_user(self, user_id, user_name):
+        self._execute(
+            'INSERT INTO users (id, name) VALUES (?, ?) '
+            'ON CONFLICT (id) DO UPDATE SET name = excluded.name;',
             (user_id, user_name)
         )
 
@@ -99,51 +344,70 @@ class Database():
         return None
 
 
+    def get_quiz_ids(self):
+        self._execute(
+            'SELECT id FROM quizzes;'
+        )
+        return {row[0] for row in self.cursor.fetchall()}
+
+
+    def get_quiz_timestamps(self):
+        self._execute(
+            'SELECT id, ts FROM quizzes;'
+        )
+        return self.cursor.fetchall()
+
+
     def add_quiz(self, quiz_id, quiz_name, quiz_url, quiz_ts):
+        quiz_ts = float(quiz_ts)
         self._execute(
-            'INSERT INTO quizzes (id, name, url, ts) VALUES (?, ?, ?, ?);',
-            (quiz_id, quiz_name, quiz_url, quiz_ts)
+            'INSERT INTO quizzes (id, name, url, ts, quiz_date, is_am) '
+            f'VALUES (?, ?, ?, ?, {QUIZ_DATE_SQL.format(ts="?")}, {QUIZ_IS_AM_SQL.format(ts="?")});',
+            (quiz_id, quiz_name, quiz_url, quiz_ts, quiz_ts, quiz_ts)
         )
 
 
     def add_score(self, user_id, quiz_id, channel_id, score, ts):
+        ts = float(ts)
+        # the score and the aggregates built from it are in the same
+        # transaction, which commits with the rest of this unit of work
         self._execute(
             'INSERT INTO scores (user_id, quiz_id, channel_id, score, ts) VALUES (?, ?, ?, ?, ?);',
             (user_id, quiz_id, channel_id, score, ts)
         )
+        self._execute(
+            'SELECT ts FROM quizzes WHERE id = ?;',
+            (quiz_id,)
+        )
+        row = self.cursor.fetchone()
+        quiz_ts = row[0] if row else None
+        add_user_score(self.cursor, user_id, score, quiz_ts, ts)
+        if row:
+            add_quiz_score(self.cursor, quiz_id, quiz_ts, user_id, score)
 
 
     def find_quiz(self, ts, is_am, is_pm, days_ago=0):
         # shift ts to the correct day
         timestamp = float(ts) - (24 * 60 * 60 * days_ago)
-        timestamp_date = datetime.datetime.fromtimestamp(timestamp).date()
-        midday = datetime.time(12, 0)
-        # get quizzes 24h either side of timestamp
-        lower = timestamp - (24 * 60 * 60)
-        upper = timestamp + (24 * 60 * 60)
+        # match on am/pm/none, otherwise the latest quiz that day
+        if is_am:
+            half_sql = 'AND is_am = 1 '
+        elif is_pm:
+            half_sql = 'AND is_am = 0 '
+        else:
+            half_sql = ''
         self._execute(
             'SELECT id, name, url, ts '
             'FROM quizzes '
-            'WHERE ts > ? AND ts < ? '
-            'ORDER BY ts DESC;',
-            (lower, upper)
+            f'WHERE quiz_date = {QUIZ_DATE_SQL.format(ts="?")} '
+            f'{half_sql}'
+            'ORDER BY ts DESC '
+            'LIMIT 1;',
+            (timestamp,)
         )
-        # return first quiz that matches
-        for quiz_id, quiz_name, quiz_url, quiz_ts in self.cursor:
-            quiz_ts_datetime = datetime.datetime.fromtimestamp(float(quiz_ts))
-            # skip quizzes on different days
-            if quiz_ts_datetime.date() != timestamp_date:
-                continue
-            # match on am/pm/none
-            if is_am:
-                if quiz_ts_datetime.time() < midday:
-                    return (quiz_id, quiz_name, quiz_url, quiz_ts)
-            elif is_pm:
-                if quiz_ts_datetime.time() >= midday:
-                    return (quiz_id, quiz_name, quiz_url, quiz_ts)
-            else:
-                # return latest quiz
-                return (quiz_id, quiz_name, quiz_url, quiz_ts)
+        rows = self.cursor.fetchall()
+        if rows:
+            return rows[0]
         return None
 
 
@@ -162,7 +426,65 @@ class Database():
         return None
 
 
-    def get_leaderboard(self, is_all_time=False):
+    def get_leaderboard(self, is_all_time=False, engine=None):
+        engine = engine or LEADERBOARD_ENGINE
+        if engine == 'stats':
+            return self.get_leaderboard_from_stats(is_all_time)
+        elif engine == 'sql':
+            return self.get_leaderboard_from_window_query(is_all_time)
+        elif engine == 'python':
+            return self.get_leaderboard_from_scores(is_all_time)
+        raise ValueError(f'unknown leaderboard engine: {engine}')
+
+
+    def get_leaderboard_from_stats(self, is_all_time=False):
+        # one row per user from the materialized user_stats
+        self._execute(
+            'SELECT user_stats.user_id, users.name, user_stats.total_quizzes, '
+            'user_stats.total_score, user_stats.recent_scores '
+            'FROM user_stats '
+            'JOIN users ON user_stats.user_id = users.id;'
+        )
+        rows = self.cursor.fetchall()
+        if not is_all_time:
+            # last 28 days worth of scores only
+            cutoff_datetime = get_leaderboard_cutoff()
+            self._execute(
+                'SELECT user_id, COUNT(*), SUM(score) '
+                'FROM scores '
+                'WHERE ts > ? '
+                'GROUP BY user_id;',
+                (cutoff_datetime,)
+            )
+            window_totals = {row[0]: row[1:] for row in self.cursor}
+
+        users = {}
+        newest_score_keys = {}
+        for user_id, user_name, total_quizzes, total_score, recent_scores in rows:
+            recent_scores = json.loads(recent_scores)
+            if not is_all_time:
+                if user_id not in window_totals:
+                    continue
+                total_quizzes, total_score = window_totals[user_id]
+                recent_scores = [entry for entry in recent_scores if entry[1] > cutoff_datetime]
+                if not recent_scores:
+                    continue
+            users[user_id] = get_leaderboard_line(
+                user_name,
+                [entry[2] for entry in recent_scores],
+                total_quizzes,
+                total_score
+            )
+            newest_score_keys[user_id] = get_recent_score_key(recent_scores[0])
+        if len(users) == 0:
+            return None
+        # order users by their newest score first, so ties on the average come
+        # out in the same order as a scan of the scores table would give
+        user_ids = sorted(users.keys(), key=newest_score_keys.get, reverse=True)
+        return sort_leaderboard(users, user_ids, is_all_time)
+
+
+    def get_leaderboard_from_scores(self, is_all_time=False):
         # sorted by quiz id (more reliable than time!) then score time
         if is_all_time:
             self._execute(
@@ -174,7 +496,7 @@ class Database():
             )
         else:
             # last 28 days worth of scores only
-            cutoff_datetime = datetime.datetime.now().timestamp() - 28 * 24 * 60 * 60
+            cutoff_datetime = get_leaderboard_cutoff()
             self._execute(
                 'SELECT scores.user_id, users.name, scores.score, scores.ts '
                 'FROM scores '
@@ -197,25 +519,122 @@ class Database():
             return None
         # calculate average and total
         for user in users.keys():
-            users[user]['total_quizzes'] = len(users[user]['scores'])
-            users[user]['average_score'] = sum(users[user]['scores']) / len(users[user]['scores'])
-            users[user]['recent_quizzes'] = len(users[user]['scores'][:10])
-            users[user]['recent_average'] = sum(users[user]['scores'][:10]) / len(users[user]['scores'][:10])
-            users[user]['recent_1_11_quizzes'] = len(users[user]['scores'][1:11])
-            users[user]['recent_1_11_average'] = sum(users[user]['scores'][1:11]) / max(1, len(users[user]['scores'][1:11]))
-            # calculate difference
-            users[user]['recent_difference'] = users[user]['recent_average'] - users[user]['recent_1_11_average']
-        leaderboard = []
+            scores = users[user]['scores']
+            users[user] = get_leaderboard_line(users[user]['name'], scores, len(scores), sum(scores))
+        return sort_leaderboard(users, users.keys(), is_all_time)
+
+
+    def get_leaderboard_from_window_query(self, is_all_time=False):
+        # rank each user's scores newest first in sql and pivot the 11 newest
+        # into columns, so only one row per user comes back, already sorted
         if is_all_time:
-            sort_fn = lambda u: users[u]['average_score']
+            where_sql = ''
+            params = ()
+            sort_sql = 'CAST(SUM(score) AS real) / COUNT(*)'
         else:
-            sort_fn = lambda u: users[u]['recent_average']
-        for user in sorted(users.keys(), key=sort_fn, reverse=True):
-            leaderboard.append(users[user])
+            # last 28 days worth of scores only
+            where_sql = 'WHERE scores.ts > ? '
+            params = (get_leaderboard_cutoff(),)
+            sort_sql = (
+                'CAST(SUM(CASE WHEN recent_rank <= 10 THEN score ELSE 0 END) AS real) '
+                '/ MIN(COUNT(*), 10)'
+            )
+        recent_columns_sql = ', '.join(
+            f'MAX(CASE WHEN recent_rank = {rank} THEN score END)'
+            for rank in range(1, RECENT_SCORES_LENGTH + 1)
+        )
+        self._execute(
+            'WITH ranked_scores AS ('
+            'SELECT scores.user_id, users.name, scores.score, quizzes.ts AS quiz_ts, scores.ts AS score_ts, '
+            'ROW_NUMBER() OVER (PARTITION BY scores.user_id ORDER BY quizzes.ts DESC, scores.ts DESC) AS recent_rank '
+            'FROM scores '
+            'JOIN users ON scores.user_id = users.id '
+            'LEFT OUTER JOIN quizzes ON scores.quiz_id = quizzes.id '
+            f'{where_sql}'
+            ') '
+            f'SELECT name, COUNT(*), SUM(score), {recent_columns_sql} '
+            'FROM ranked_scores '
+            'GROUP BY user_id '
+            # ties keep the order of each user's newest score, like the python sort
+            f'ORDER BY {sort_sql} DESC, '
+            'MAX(CASE WHEN recent_rank = 1 THEN quiz_ts END) DESC, '
+            'MAX(CASE WHEN recent_rank = 1 THEN score_ts END) DESC;',
+            params
+        )
+        leaderboard = []
+        for row in self.cursor:
+            user_name, total_quizzes, total_score = row[:3]
+            recent_scores = [score for score in row[3:] if score is not None]
+            leaderboard.append(get_leaderboard_line(user_name, recent_scores, total_quizzes, total_score))
+        if len(leaderboard) == 0:
+            return None
         return leaderboard
 
 
-    def get_quiz_stats(self):
+    def rebuild_stats(self):
+        try:
+            rebuild_user_stats(self.cursor)
+            rebuild_quiz_stats(self.cursor)
+            self.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+
+    def get_quiz_stats(self, limit=None):
+        '''
+        returns quizzes with more than 1 score from the quiz_stats aggregates,
+        easiest first. with a limit, only the easiest and hardest `limit`
+        quizzes either side of the midpoint are returned, which is all that
+        gets shown
+        '''
+        # the ranked count only reads the partial index, which holds just
+        # those quizzes. without ANALYZE sqlite picks a table scan instead
+        self._execute(
+            'SELECT EXISTS (SELECT 1 FROM quiz_stats), '
+            '(SELECT COUNT(*) FROM quiz_stats INDEXED BY quiz_stats_average_score WHERE total_scores > 1);'
+        )
+        has_quizzes, ranked_quizzes = self.cursor.fetchone()
+        if not has_quizzes:
+            return None
+        if limit is None:
+            return self._find_quiz_stats('DESC', ranked_quizzes)
+        midpoint = int(math.ceil(ranked_quizzes / 2))
+        easiest_quizzes = self._find_quiz_stats('DESC', min(limit, midpoint))
+        hardest_quizzes = self._find_quiz_stats('ASC', min(limit, ranked_quizzes - midpoint))
+        return easiest_quizzes + list(reversed(hardest_quizzes))
+
+
+    def _find_quiz_stats(self, direction, count):
+        # ties keep newest quiz first, like the python sort did
+        self._execute(
+            'SELECT quizzes.name, quizzes.url, quiz_stats.win_score, users.name, '
+            'quiz_stats.is_draw, quiz_stats.total_scores, quiz_stats.average_score '
+            'FROM quiz_stats '
+            'JOIN quizzes ON quiz_stats.quiz_id = quizzes.id '
+            'LEFT OUTER JOIN users ON quiz_stats.win_user_id = users.id '
+            'WHERE quiz_stats.total_scores > 1 '
+            f'ORDER BY quiz_stats.average_score {direction}, quiz_stats.quiz_ts {direction} '
+            'LIMIT ?;',
+            (count,)
+        )
+        return [
+            {
+                'name': quiz_name,
+                'url': quiz_url,
+                'win': {
+                    'score': win_score,
+                    'user_name': win_user_name
+                },
+                'is_draw': bool(is_draw),
+                'total_scores': total_scores,
+                'average_score': average_score
+            }
+            for quiz_name, quiz_url, win_score, win_user_name, is_draw, total_scores, average_score in self.cursor
+        ]
+
+
+    def get_quiz_stats_from_scores(self):
         self._execute(
             'SELECT quizzes.id, quizzes.name, quizzes.url, scores.score, users.name '
             'FROM quizzes '
@@ -279,3 +698,71 @@ class Database():
         rows = self.cursor.fetchall()
         scores = list(row[0] for row in rows)
         return scores
+
+
+def get_explain_queries(db):
+    # (name, fn) for every read query, with arguments from the data
+    db._execute('SELECT id, ts FROM quizzes ORDER BY ts DESC LIMIT 1;')
+    quiz_id, quiz_ts = db.cursor.fetchone() or ('0', datetime.datetime.now().timestamp())
+    db._execute('SELECT id, name FROM users LIMIT 1;')
+    user_id, user_name = db.cursor.fetchone() or ('U0', 'nobody')
+    queries = [
+        ('find_quiz', lambda: db.find_quiz(quiz_ts, False, False)),
+        ('find_quiz[am]', lambda: db.find_quiz(quiz_ts, True, False)),
+        ('find_quiz_score', lambda: db.find_quiz_score(user_id, quiz_id)),
+        ('get_quiz_by_id', lambda: db.get_quiz_by_id(quiz_id)),
+        ('get_user_name_by_id', lambda: db.get_user_name_by_id(user_id)),
+        ('get_channel_name_by_id', lambda: db.get_channel_name_by_id('C0')),
+        ('get_users', db.get_users),
+        ('get_channels', db.get_channels),
+        ('find_users_by_name_substring', lambda: db.find_users_by_name_substring(user_name)),
+        ('find_recent_scores_by_user_id', lambda: db.find_recent_scores_by_user_id(user_id, 10)),
+        ('get_quiz_stats', lambda: db.get_quiz_stats(3)),
+        ('get_quiz_stats_from_scores', db.get_quiz_stats_from_scores),
+    ]
+    for engine in ('stats', 'sql', 'python'):
+        queries.append((f'get_leaderboard[{engine}]', lambda engine=engine: db.get_leaderboard(False, engine)))
+        queries.append((f'get_leaderboard_all_time[{engine}]', lambda engine=engine: db.get_leaderboard(True, engine)))
+    return queries
+
+
+def explain(db):
+    # runs every read query, then prints the plan of each statement it issued
+    db._execute("SELECT name FROM sqlite_master WHERE type = 'table';")
+    tables = {row[0] for row in db.cursor.fetchall()}
+    table_scans = []
+    for name, fn in get_explain_queries(db):
+        statements = []
+        db.on_execute = lambda sql, params, seconds: statements.append((sql, params, seconds))
+        try:
+            fn()
+        finally:
+            db.on_execute = None
+        for sql, params, seconds in statements:
+            print(f'{name} ({1000 * seconds:.2f}ms): {sql}')
+            for line in db.explain_query(sql, params):
+                # a SCAN of a whole table, not through an index or of a subquery's results
+                words = line.split()
+                is_table_scan = words[:1] == ['SCAN'] and words[1] in tables and ' USING ' not in line
+                print(f'    {line}' + ('    <-- table scan' if is_table_scan else ''))
+                if is_table_scan:
+                    table_scans.append(f'{name}: {line.strip()}')
+        print()
+    print(f'{len(table_scans)} table scan(s)')
+    for table_scan in table_scans:
+        print(f'  {table_scan}')
+
+
+if __name__ == '__main__':
+    # maintenance commands, e.g. python db.py quiz-scorer.db rebuild-stats
+    if len(sys.argv) != 3 or sys.argv[2] not in ('rebuild-stats', 'explain'):
+        print(f'usage: {sys.argv[0]} <database> rebuild-stats|explain')
+        sys.exit(1)
+    with Database(sys.argv[1]) as db:
+        db.initialize()
+        if sys.argv[2] == 'explain':
+            explain(db)
+        else:
+            print('rebuilding stats...')
+            db.rebuild_stats()
+            print('done!')
@@ -0,0 +1,197 @@
+import time
+import threading
+
+from slack.errors import SlackApiError
+
+from metrics import METRICS
+
+
+# names are refreshed in the background once they are this old
+DIRECTORY_TTL_SECONDS   = 6 * 60 * 60
+# ids slack couldn't tell us about aren't asked about again for this long
+NEGATIVE_TTL_SECONDS    = 10 * 60
+PAGE_LIMIT              = 200
+# slack's answer for an id that doesn't exist, or that we can't see
+NOT_FOUND_ERRORS        = {'user_not_found', 'channel_not_found'}
+
+SLACK_CALL_SECONDS = METRICS.histogram('slack_call_seconds', 'Time taken by slack web api calls', ('method',))
+
+
+class Directory():
+    '''
+    in-process cache of slack user and channel names
+
+    it is loaded from the database and bulk-fetched from slack at startup,
+    so the message hot path is a dict lookup. names past their ttl are still
+    served while they are refreshed in the background; only ids that have
+    never been seen are looked up one at a time, and unknown ids are
+    negatively cached. on_user_changed/on_channel_changed are called with
+    (id, name) whenever a name is new or different, to persist it
+    '''
+    def __init__(self, on_user_changed=None, on_channel_changed=None,
+            ttl_seconds=DIRECTORY_TTL_SECONDS, negative_ttl_seconds=NEGATIVE_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self.negative_ttl_seconds = negative_ttl_seconds
+        # id -> (name or None, expires_at)
+        self.users = {}
+        self.channels = {}
+        self.refreshing = set()
+        self.lock = threading.Lock()
+        self.on_user_changed = on_user_changed
+        self.on_channel_changed = on_channel_changed
+
+
+    def load(self, users, channels):
+        # (id, name) rows from the database, refreshed as soon as they're used
+        with self.lock:
+            for user_id, user_name in users:
+                self.users[user_id] = (user_name, 0)
+            for channel_id, channel_name in channels:
+                self.channels[channel_id] = (channel_name, 0)
+
+
+    def warm_up(self, web_client):
+        user_count = 0
+        for page in self.get_pages(web_client.users_list):
+            for user in page['members']:
+                self.set_user_name(user['id'], user['profile']['display_name'])
+                user_count += 1
+        channel_count = 0
+        for page in self.get_pages(web_client.conversations_list, types='public_channel,private_channel'):
+            for channel in page['channels']:
+                self.set_channel_name(channel['id'], channel['name'])
+                channel_count += 1
+        print(f'directory has {user_count} users and {channel_count} channels from slack')
+
+
+    def get_pages(self, method, **kwargs):
+        cursor = None
+        while True:
+            with SLACK_CALL_SECONDS.time(method=method.__name__):
+                response = method(limit=PAGE_LIMIT, cursor=cursor, **kwargs)
+            yield response.data
+            cursor = response.data.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                break
+
+
+    def set_user_name(self, user_id, user_name):
+        self.set_name(self.users, user_id, user_name, self.on_user_changed)
+
+
+    def set_channel_name(self, channel_id, channel_name):
+        self.set_name(self.channels, channel_id, channel_name, self.on_channel_changed)
+
+
+    def set_name(self, entries, entry_id, name, on_changed):
+        expires_at = time.monotonic() + self.ttl_seconds
+        with self.lock:
+            existing_entry = entries.get(entry_id)
+            entries[entry_id] = (name, expires_at)
+        if existing_entry and existing_entry[0] == name:
+            return
+        if on_changed:
+            on_changed(entry_id, name)
+
+
+    def get_channels(self):
+        # (id, name) of the channels whose names are known and current
+        now = time.monotonic()
+        with self.lock:
+            return [
+                (channel_id, channel_name)
+                for channel_id, (channel_name, expires_at) in self.channels.items()
+                if channel_name is not None and now < expires_at
+            ]
+
+
+    def get_user_name(self, user_id, web_client):
+        return self.get_name(self.users, user_id, web_client, self.fetch_user_name, self.set_user_name)
+
+
+    def get_channel_name(self, channel_id, web_client):
+        return self.get_name(self.channels, channel_id, web_client, self.fetch_channel_name, self.set_channel_name)
+
+
+    def get_name(self, entries, entry_id, web_client, fetch_fn, set_fn):
+        entry = entries.get(entry_id)
+        if entry is not None:
+            name, expires_at = entry
+            is_expired = time.monotonic() >= expires_at
+            if name is not None:
+                if is_expired:
+                    self.refresh_in_background(entry_id, web_client, fetch_fn, set_fn)
+                return name
+            if not is_expired:
+                return None
+        # never seen before (or unknown for a while), we have to ask
+        name = fetch_fn(entry_id, web_client)
+        if name is None:
+            with self.lock:
+                entries[entry_id] = (None, time.monotonic() + self.negative_ttl_seconds)
+            return None
+        set_fn(entry_id, name)
+        return name
+
+
+    def refresh_in_background(self, entry_id, web_client, fetch_fn, set_fn):
+        with self.lock:
+            if entry_id in self.refreshing:
+                return
+            self.refreshing.add(entry_id)
+
+        def refresh():
+            try:
+                name = fetch_fn(entry_id, web_client)
+                if name is not None:
+                    set_fn(entry_id, name)
+            except Exception as e:
+                print(f'could not refresh {entry_id}: {e}')
+            finally:
+                with self.lock:
+                    self.refreshing.discard(entry_id)
+
+        threading.Thread(target=refresh, name=f'directory-{entry_id}', daemon=True).start()
+
+
+    def fetch_user_name(self, user_id, web_client):
+        if user_id.startswith('U'):
+            # regular user
+            try:
+                with SLACK_CALL_SECONDS.time(method='users_info'):
+                    response = web_client.users_info(user=user_id)
+            except SlackApiError as e:
+                return get_not_found_name(user_id, e)
+            return response.data['user']['profile']['display_name']
+        print(f'Unknown user type: {user_id}')
+        return None
+
+
+    def fetch_channel_name(self, channel_id, web_client):
+        if channel_id.startswith('G'):
+            # private channel
+            try:
+                with SLACK_CALL_SECONDS.time(method='groups_info'):
+                    response = web_client.groups_info(channel=channel_id)
+            except SlackApiError as e:
+                return get_not_found_name(channel_id, e)
+            return response.data['group']['name']
+        elif channel_id.startswith('C'):
+            # ordinary channel
+            try:
+                with SLACK_CALL_SECONDS.time(method='channels_info'):
+                    response = web_client.channels_info(channel=channel_id)
+            except SlackApiError as e:
+                return get_not_found_name(channel_id, e)
+            return response.data['channel']['name']
+        print(f'Unknown channel type: {channel_id}')
+        return None
+
+
+def get_not_found_name(entry_id, e):
+    # None for an id slack doesn't know, so it's negatively cached like an
+    # unknown id type. anything else is still an error
+    if e.response.get('error') not in NOT_FOUND_ERRORS:
+        raise e
+    print(f'{entry_id} not found in slack: {e.response.get("error")}')
+    return None
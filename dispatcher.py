@@ -0,0 +1,327 @@
+import time
+import heapq
+import random
+import itertools
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+from slack.errors import SlackApiError
+
+from metrics import METRICS
+
+
+SLACK_WORKERS       = 2
+# calls per second (and how many can go at once) for each web api method,
+# from slack's rate limit tiers. chat.postMessage is limited per channel
+RATE_LIMITS = {
+    'chat_postMessage': (1, 3),
+    'reactions_add': (50 / 60, 5)
+}
+DEFAULT_RATE_LIMIT  = (20 / 60, 3)
+MAX_ATTEMPTS        = 5
+BACKOFF_SECONDS     = 1
+MAX_BACKOFF_SECONDS = 30
+# send latencies kept for the stats
+LATENCY_SAMPLES     = 1000
+
+SLACK_CALL_SECONDS  = METRICS.histogram('slack_call_seconds', 'Time taken by slack web api calls', ('method',))
+SLACK_SEND_SECONDS  = METRICS.histogram('slack_send_seconds', 'Time from queueing a slack call to it being sent', ('method',))
+SLACK_CALLS         = METRICS.counter('slack_calls_total', 'Slack web api calls by outcome', ('method', 'outcome'))
+
+
+def get_mrkdwn_blocks(mrkdwn):
+    return [
+        {
+            "type": "section",
+            "text": {
+                "type": "mrkdwn",
+                "text": mrkdwn
+            }
+        }
+    ]
+
+
+class RateLimiter():
+    '''
+    token buckets per (method, channel). reserve() hands out the time a call
+    may go at, acquire() only takes a token that's there now. a Retry-After
+    from slack pauses the bucket
+    '''
+    def __init__(self, rate_limits=RATE_LIMITS, default_rate_limit=DEFAULT_RATE_LIMIT):
+        self.rate_limits = rate_limits
+        self.default_rate_limit = default_rate_limit
+        self.lock = threading.Lock()
+        # key -> (tokens, updated_at)
+        self.buckets = {}
+        self.paused_until = {}
+
+
+    def reserve(self, key):
+        # returns how long to wait before making the call
+        rate, burst = self.rate_limits.get(key[0], self.default_rate_limit)
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated_at = self.buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated_at) * rate) - 1
+            self.buckets[key] = (tokens, now)
+            wait_seconds = -tokens / rate if tokens < 0 else 0
+            return max(wait_seconds, self.paused_until.get(key, 0) - now)
+
+
+    def acquire(self, key):
+        # takes a token and returns 0, or returns how long until there's one
+        # to take, without waiting for it
+        rate, burst = self.rate_limits.get(key[0], self.default_rate_limit)
+        now = time.monotonic()
+        with self.lock:
+            paused_seconds = self.paused_until.get(key, 0) - now
+            if paused_seconds > 0:
+                return paused_seconds
+            tokens, updated_at = self.buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated_at) * rate)
+            if tokens < 1:
+                self.buckets[key] = (tokens, now)
+                return (1 - tokens) / rate
+            self.buckets[key] = (tokens - 1, now)
+            return 0
+
+
+    def pause(self, key, seconds):
+        with self.lock:
+            self.paused_until[key] = max(self.paused_until.get(key, 0), time.monotonic() + seconds)
+
+
+class OutboundCall():
+    def __init__(self, method_name, kwargs, coalesce_key=None):
+        self.method_name = method_name
+        self.kwargs = kwargs
+        self.coalesce_key = coalesce_key
+        self.future = Future()
+        self.submitted_at = time.monotonic()
+        self.attempts = 0
+        # mrkdwn line -> times it was posted, for coalesced messages
+        self.lines = {}
+
+
+    def get_rate_limit_key(self):
+        return (self.method_name, self.kwargs.get('channel'))
+
+
+class SlackDispatcher():
+    '''
+    sends web api calls on worker threads, so handlers don't wait on slack
+
+    calls queue in a lane per (method, channel), so a channel's messages go
+    out in order, and lanes wait in a heap until their next call may go.
+    calls are paced by a RateLimiter, wait out a 429's Retry-After and are
+    retried with exponential backoff on network and server errors, all
+    without a worker sleeping, so one busy channel doesn't hold up the
+    rest. messages posted with the same coalesce_key while one is still
+    queued are merged into it, so a burst of the same error reply goes out
+    as one message. submit() returns a future holding the slack response
+    '''
+    def __init__(self, web_client, workers=SLACK_WORKERS, rate_limiter=None,
+            max_attempts=MAX_ATTEMPTS, backoff_seconds=BACKOFF_SECONDS):
+        self.web_client = web_client
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        # lane key -> calls waiting in it, the first is the next to go
+        self.lanes = {}
+        # (ready_at, order, lane key) for each lane with a call waiting to go
+        self.heap = []
+        self.order = itertools.count()
+        # coalesce_key -> queued call
+        self.pending = {}
+        self.threads = [
+            threading.Thread(target=self.run, name=f'slack-dispatcher-{index}', daemon=True)
+            for index in range(workers)
+        ]
+        self.alive = True
+        self.sent_count = 0
+        self.failed_count = 0
+        self.retry_count = 0
+        self.rate_limited_count = 0
+        self.coalesced_count = 0
+        self.send_seconds = deque(maxlen=LATENCY_SAMPLES)
+
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+
+    def submit(self, method_name, **kwargs):
+        call = OutboundCall(method_name, kwargs)
+        self.enqueue(call)
+        return call.future
+
+
+    def post_mrkdwn(self, channel_id, mrkdwn, coalesce_key=None):
+        with self.lock:
+            call = self.pending.get(coalesce_key) if coalesce_key is not None else None
+            if call is not None:
+                call.lines[mrkdwn] = call.lines.get(mrkdwn, 0) + 1
+                self.coalesced_count += 1
+                SLACK_CALLS.inc(method=call.method_name, outcome='coalesced')
+                return call.future
+            call = OutboundCall('chat_postMessage', {'channel': channel_id}, coalesce_key)
+            call.lines[mrkdwn] = 1
+            if coalesce_key is not None:
+                self.pending[coalesce_key] = call
+        self.enqueue(call)
+        return call.future
+
+
+    def enqueue(self, call):
+        if not self.alive:
+            call.future.set_exception(RuntimeError('slack dispatcher has stopped'))
+            return
+        lane_key = call.get_rate_limit_key()
+        with self.lock:
+            lane = self.lanes.setdefault(lane_key, deque())
+            lane.append(call)
+            # otherwise it's in the heap (or being sent) already
+            if len(lane) == 1:
+                self.schedule(lane_key, 0)
+
+
+    def schedule(self, lane_key, delay_seconds):
+        # self.lock must be held
+        heapq.heappush(self.heap, (time.monotonic() + delay_seconds, next(self.order), lane_key))
+        self.ready.notify()
+
+
+    def get_queue_depth(self):
+        with self.lock:
+            return sum(len(lane) for lane in self.lanes.values())
+
+
+    def get_ready_lane(self):
+        # blocks until a lane's call may go, None once stopped and drained
+        with self.lock:
+            while True:
+                if self.heap:
+                    ready_at, _, lane_key = self.heap[0]
+                    wait_seconds = ready_at - time.monotonic()
+                    if wait_seconds <= 0:
+                        heapq.heappop(self.heap)
+                        return lane_key
+                    self.ready.wait(wait_seconds)
+                elif not self.alive:
+                    return None
+                else:
+                    self.ready.wait()
+
+
+    def run(self):
+        while True:
+            lane_key = self.get_ready_lane()
+            if lane_key is None:
+                break
+            wait_seconds = self.rate_limiter.acquire(lane_key)
+            if wait_seconds > 0:
+                with self.lock:
+                    self.schedule(lane_key, wait_seconds)
+                continue
+            with self.lock:
+                call = self.lanes[lane_key][0]
+            retry_seconds = self.send(call)
+            with self.lock:
+                if retry_seconds is not None:
+                    # it stays first in its lane, so the lane keeps its order
+                    self.schedule(lane_key, retry_seconds)
+                    continue
+                lane = self.lanes[lane_key]
+                lane.popleft()
+                if lane:
+                    self.schedule(lane_key, 0)
+                else:
+                    del self.lanes[lane_key]
+
+
+    def send(self, call):
+        # returns how long to wait before trying it again, or None when done
+        if call.lines:
+            with self.lock:
+                # nothing more can be merged in once it's going out
+                if self.pending.get(call.coalesce_key) is call:
+                    del self.pending[call.coalesce_key]
+                mrkdwn = '\n'.join(
+                    f'{line} (x{count})' if count > 1 else line
+                    for line, count in call.lines.items()
+                )
+            call.kwargs['blocks'] = get_mrkdwn_blocks(mrkdwn)
+        call.attempts += 1
+        t0 = time.perf_counter()
+        try:
+            response = getattr(self.web_client, call.method_name)(**call.kwargs)
+        except Exception as e:
+            SLACK_CALL_SECONDS.observe(time.perf_counter() - t0, method=call.method_name)
+            return self.retry_or_fail(call, e)
+        SLACK_CALL_SECONDS.observe(time.perf_counter() - t0, method=call.method_name)
+        SLACK_SEND_SECONDS.observe(time.monotonic() - call.submitted_at, method=call.method_name)
+        SLACK_CALLS.inc(method=call.method_name, outcome='ok')
+        self.send_seconds.append(time.monotonic() - call.submitted_at)
+        self.sent_count += 1
+        call.future.set_result(response)
+        return None
+
+
+    def retry_or_fail(self, call, e):
+        retry_after = None
+        if isinstance(e, SlackApiError):
+            status_code = getattr(e.response, 'status_code', None)
+            if status_code == 429:
+                headers = getattr(e.response, 'headers', None) or {}
+                retry_after = float(headers.get('Retry-After') or headers.get('retry-after') or 1)
+                self.rate_limited_count += 1
+                SLACK_CALLS.inc(method=call.method_name, outcome='rate-limited')
+            elif status_code is None or status_code < 500:
+                # slack said no (e.g. already_reacted), trying again won't help
+                self.fail(call, e)
+                return None
+        if call.attempts >= self.max_attempts or not self.alive:
+            self.fail(call, e)
+            return None
+        self.retry_count += 1
+        SLACK_CALLS.inc(method=call.method_name, outcome='retried')
+        if retry_after is not None:
+            # everything else for this method/channel has to wait too
+            self.rate_limiter.pause(call.get_rate_limit_key(), retry_after)
+            return retry_after
+        backoff_seconds = min(MAX_BACKOFF_SECONDS, self.backoff_seconds * 2 ** (call.attempts - 1))
+        return backoff_seconds * random.uniform(0.5, 1)
+
+
+    def fail(self, call, e):
+        self.failed_count += 1
+        SLACK_CALLS.inc(method=call.method_name, outcome='failed')
+        print(f'could not send {call.method_name} to slack after {call.attempts} attempt(s): {e}')
+        call.future.set_exception(e)
+
+
+    def get_stats(self):
+        send_seconds = sorted(self.send_seconds)
+        return {
+            'queue_depth': self.get_queue_depth(),
+            'sent': self.sent_count,
+            'failed': self.failed_count,
+            'retries': self.retry_count,
+            'rate_limited': self.rate_limited_count,
+            'coalesced': self.coalesced_count,
+            'send_seconds_p50': send_seconds[len(send_seconds) // 2] if send_seconds else None,
+            'send_seconds_max': send_seconds[-1] if send_seconds else None
+        }
+
+
+    def stop(self):
+        # the workers finish what's queued first, without retrying
+        with self.lock:
+            self.alive = False
+            self.ready.notify_all()
+        for thread in self.threads:
+            thread.join()
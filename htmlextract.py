@@ -0,0 +1,237 @@
+'''
+pulls the few bits the stuff poller needs out of stuff's (large) pages
+
+    extract_quiz_links(html)    -> [(name, href)] for `.main_article h3 a`
+    extract_byline_date(html)   -> text of the first `.sics-component__byline__date`
+
+the fast backends are lxml (if it's installed) and a streaming html.parser
+extractor that stops as soon as it has what it needs. if the fast backend
+finds nothing or fails, BeautifulSoup (what the poller always used) gets a
+go, in case the page is shaped in a way the fast path doesn't understand
+'''
+import os
+from html.parser import HTMLParser
+
+from bs4 import BeautifulSoup
+
+try:
+    import lxml.html
+    import lxml.etree
+except ImportError:
+    lxml = None
+
+
+# 'auto' is lxml if it's installed, otherwise 'stream'
+HTML_BACKEND        = os.environ.get('HTML_BACKEND', 'auto')
+QUIZ_LINK_CLASS     = 'main_article'
+BYLINE_DATE_CLASS   = 'sics-component__byline__date'
+# the lxml byline extractor feeds the page in chunks this big
+FEED_CHUNK_SIZE     = 16 * 1024
+# what the fast backends read pages as, stuff's pages are all utf-8
+HTML_ENCODING       = 'utf-8'
+# elements that never have an end tag
+VOID_TAGS = {
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+    'link', 'meta', 'param', 'source', 'track', 'wbr'
+}
+
+
+def decode_html(html):
+    if isinstance(html, bytes):
+        return html.decode(HTML_ENCODING, errors='replace')
+    return html
+
+
+def encode_html(html):
+    # lxml won't take a str that has an xml encoding declaration
+    if isinstance(html, str):
+        return html.encode(HTML_ENCODING)
+    return html
+
+
+def has_class(class_attribute, class_name):
+    return class_name in (class_attribute or '').split()
+
+
+class SoupExtractor():
+    name = 'bs4'
+
+
+    def extract_quiz_links(self, html):
+        soup = BeautifulSoup(html, 'html.parser')
+        return [(a.text, a.attrs['href']) for a in soup.select(f'.{QUIZ_LINK_CLASS} h3 a')]
+
+
+    def extract_byline_date(self, html):
+        soup = BeautifulSoup(html, 'html.parser')
+        dates = soup.select(f'.{BYLINE_DATE_CLASS}')
+        return dates[0].text if dates else None
+
+
+class LxmlExtractor():
+    name = 'lxml'
+    QUIZ_LINK_XPATH = (
+        f"//*[contains(concat(' ', normalize-space(@class), ' '), ' {QUIZ_LINK_CLASS} ')]//h3//a[@href]"
+    )
+
+
+    def extract_quiz_links(self, html):
+        parser = lxml.html.HTMLParser(encoding=HTML_ENCODING)
+        document = lxml.html.document_fromstring(encode_html(html), parser=parser)
+        return [(a.text_content(), a.get('href')) for a in document.xpath(self.QUIZ_LINK_XPATH)]
+
+
+    def extract_byline_date(self, html):
+        # a pull parser, so we can stop reading once the byline has ended
+        html = encode_html(html)
+        parser = lxml.etree.HTMLPullParser(events=('end',), encoding=HTML_ENCODING)
+        for start in range(0, len(html), FEED_CHUNK_SIZE):
+            parser.feed(html[start:start + FEED_CHUNK_SIZE])
+            for _, element in parser.read_events():
+                if has_class(element.get('class'), BYLINE_DATE_CLASS):
+                    return ''.join(element.itertext())
+        return None
+
+
+class StopParsing(Exception):
+    pass
+
+
+class QuizLinkParser(HTMLParser):
+    '''
+    collects the text and href of every a inside an h3 inside a main_article
+    '''
+    def __init__(self):
+        super().__init__()
+        # (tag, is main_article) for every open element
+        self.stack = []
+        self.main_article_depth = 0
+        self.h3_depth = 0
+        self.link = None
+        self.links = []
+
+
+    def handle_starttag(self, tag, attrs):
+        if tag in VOID_TAGS:
+            return
+        is_main_article = has_class(dict(attrs).get('class'), QUIZ_LINK_CLASS)
+        self.stack.append((tag, is_main_article))
+        self.main_article_depth += is_main_article
+        if tag == 'h3':
+            self.h3_depth += 1
+        elif tag == 'a' and self.main_article_depth and self.h3_depth and self.link is None:
+            href = dict(attrs).get('href')
+            if href is not None:
+                self.link = [[], href]
+
+
+    def handle_endtag(self, tag):
+        # close everything left open inside it too, like a browser would
+        if not any(open_tag == tag for open_tag, _ in self.stack):
+            return
+        while self.stack:
+            open_tag, is_main_article = self.stack.pop()
+            self.main_article_depth -= is_main_article
+            if open_tag == 'h3':
+                self.h3_depth -= 1
+            elif open_tag == 'a' and self.link is not None:
+                self.links.append((''.join(self.link[0]), self.link[1]))
+                self.link = None
+            if open_tag == tag:
+                break
+
+
+    def handle_data(self, data):
+        if self.link is not None:
+            self.link[0].append(data)
+
+
+class BylineDateParser(HTMLParser):
+    '''
+    collects the text of the first element with the byline date class, then
+    stops the parse
+    '''
+    def __init__(self):
+        super().__init__()
+        self.tag = None
+        self.depth = 0
+        self.text = None
+
+
+    def handle_starttag(self, tag, attrs):
+        if tag in VOID_TAGS:
+            return
+        if self.tag is not None:
+            if tag == self.tag:
+                self.depth += 1
+        elif has_class(dict(attrs).get('class'), BYLINE_DATE_CLASS):
+            self.tag = tag
+            self.depth = 1
+            self.text = []
+
+
+    def handle_endtag(self, tag):
+        if self.tag is not None and tag == self.tag:
+            self.depth -= 1
+            if self.depth == 0:
+                raise StopParsing()
+
+
+    def handle_data(self, data):
+        if self.text is not None:
+            self.text.append(data)
+
+
+class StreamExtractor():
+    name = 'stream'
+
+
+    def extract_quiz_links(self, html):
+        parser = QuizLinkParser()
+        parser.feed(decode_html(html))
+        parser.close()
+        return parser.links
+
+
+    def extract_byline_date(self, html):
+        parser = BylineDateParser()
+        try:
+            parser.feed(decode_html(html))
+        except StopParsing:
+            pass
+        return ''.join(parser.text) if parser.text is not None else None
+
+
+EXTRACTORS = {extractor.name: extractor for extractor in (SoupExtractor(), StreamExtractor())}
+if lxml is not None:
+    EXTRACTORS[LxmlExtractor.name] = LxmlExtractor()
+
+
+def get_extractor(backend=None):
+    backend = backend or HTML_BACKEND
+    if backend == 'auto':
+        backend = 'lxml' if 'lxml' in EXTRACTORS else 'stream'
+    return EXTRACTORS[backend]
+
+
+def extract(method_name, html, backend=None):
+    extractor = get_extractor(backend)
+    fallback = EXTRACTORS['bs4']
+    if extractor is fallback:
+        return getattr(fallback, method_name)(html)
+    try:
+        result = getattr(extractor, method_name)(html)
+    except Exception as e:
+        print(f'{extractor.name} could not {method_name.replace("_", " ")}, trying bs4: {e}')
+        result = None
+    if not result:
+        result = getattr(fallback, method_name)(html)
+    return result
+
+
+def extract_quiz_links(html, backend=None):
+    return extract('extract_quiz_links', html, backend)
+
+
+def extract_byline_date(html, backend=None):
+    return extract('extract_byline_date', html, backend)
@@ -0,0 +1,273 @@
+import os
+import time
+import bisect
+import functools
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+METRICS_PREFIX      = 'quizscorer_'
+# where prometheus can scrape /metrics, 0 turns it off
+METRICS_HOST        = os.environ.get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT        = int(os.environ.get('METRICS_PORT', 9464))
+# how often the summary is printed, 0 turns it off
+METRICS_LOG_SECONDS = int(os.environ.get('METRICS_LOG_SECONDS', 15 * 60))
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30
+)
+
+
+def get_labels_text(label_names, label_values, extra=''):
+    labels = [f'{name}="{value}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        labels.append(extra)
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+class Counter():
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+        # label values -> count
+        self.values = {}
+
+
+    def inc(self, value=1, **labels):
+        key = tuple(str(labels[name]) for name in self.label_names)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+
+    def get_lines(self):
+        yield f'# HELP {self.name} {self.help_text}'
+        yield f'# TYPE {self.name} counter'
+        with self.lock:
+            values = sorted(self.values.items())
+        for key, value in values:
+            yield f'{self.name}{get_labels_text(self.label_names, key)} {value}'
+
+
+    def get_summary(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        return ', '.join(f'{"/".join(key) or "total"}={value}' for key, value in values)
+
+
+class Gauge():
+    '''
+    a value read from fn when the metrics are collected, e.g. a queue depth
+    '''
+    def __init__(self, name, help_text, fn):
+        self.name = name
+        self.help_text = help_text
+        self.fn = fn
+
+
+    def get_lines(self):
+        yield f'# HELP {self.name} {self.help_text}'
+        yield f'# TYPE {self.name} gauge'
+        yield f'{self.name} {self.fn()}'
+
+
+    def get_summary(self):
+        return str(self.fn())
+
+
+class Histogram():
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        # label values -> [count per bucket (and one over), sum]
+        self.values = {}
+
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.label_names)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+
+    @contextmanager
+    def time(self, **labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+
+    def get_entries(self):
+        with self.lock:
+            return sorted((key, list(counts), total) for key, (counts, total) in self.values.items())
+
+
+    def get_lines(self):
+        yield f'# HELP {self.name} {self.help_text}'
+        yield f'# TYPE {self.name} histogram'
+        for key, counts, total in self.get_entries():
+            cumulative = 0
+            for bucket, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                bucket_text = 'le="' + str(bucket) + '"'
+                yield f'{self.name}_bucket{get_labels_text(self.label_names, key, bucket_text)} {cumulative}'
+            labels_text = get_labels_text(self.label_names, key)
+            yield f'{self.name}_sum{labels_text} {total}'
+            yield f'{self.name}_count{labels_text} {cumulative}'
+
+
+    def get_quantile(self, counts, quantile):
+        # the upper bound of the bucket the quantile falls in
+        target = quantile * sum(counts)
+        cumulative = 0
+        for bucket, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            if cumulative >= target:
+                return bucket
+        return float('inf')
+
+
+    def get_summary(self):
+        parts = []
+        for key, counts, total in self.get_entries():
+            count = sum(counts)
+            parts.append(
+                f'{"/".join(key) or "total"}={count} '
+                f'({1000 * total / count:.1f}ms avg, p95<={1000 * self.get_quantile(counts, 0.95):g}ms)'
+            )
+        return ', '.join(parts)
+
+
+class MetricsRegistry():
+    '''
+    the process's counters, gauges and histograms by name. asking for a
+    metric that exists returns it, so modules can share them
+    '''
+    def __init__(self, prefix=METRICS_PREFIX):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+
+    def get_or_add(self, name, cls, *args, **kwargs):
+        name = self.prefix + name
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, *args, **kwargs)
+            return metric
+
+
+    def counter(self, name, help_text, label_names=()):
+        return self.get_or_add(name, Counter, help_text, label_names)
+
+
+    def gauge(self, name, help_text, fn):
+        return self.get_or_add(name, Gauge, help_text, fn)
+
+
+    def histogram(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        return self.get_or_add(name, Histogram, help_text, label_names, buckets)
+
+
+    def get_metrics(self):
+        with self.lock:
+            return sorted(self.metrics.items())
+
+
+    def get_text(self):
+        # prometheus text exposition format
+        lines = []
+        for name, metric in self.get_metrics():
+            lines.extend(metric.get_lines())
+        return '\n'.join(lines) + '\n'
+
+
+    def get_summary(self):
+        lines = []
+        for name, metric in self.get_metrics():
+            summary = metric.get_summary()
+            if summary:
+                lines.append(f'  {name[len(self.prefix):]}: {summary}')
+        return '\n'.join(lines)
+
+
+METRICS = MetricsRegistry()
+
+
+def timed_methods(histogram):
+    '''
+    class decorator timing every public method into histogram, labelled
+    with the method name
+    '''
+    def decorate(cls):
+        for name, fn in list(vars(cls).items()):
+            if name.startswith('_') or not callable(fn):
+                continue
+            setattr(cls, name, get_timed_method(histogram, name, fn))
+        return cls
+    return decorate
+
+
+def get_timed_method(histogram, name, fn):
+    @functools.wraps(fn)
+    def timed_method(*args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - t0, method=name)
+    return timed_method
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = METRICS.get_text().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
+
+
+class MetricsReporter(threading.Thread):
+    '''
+    prints the metrics summary every interval_seconds
+    '''
+    def __init__(self, interval_seconds=METRICS_LOG_SECONDS):
+        super().__init__(name='metrics-reporter', daemon=True)
+        self.interval_seconds = interval_seconds
+        self.stopped = threading.Event()
+
+
+    def run(self):
+        while not self.stopped.wait(self.interval_seconds):
+            print(f'metrics:\n{METRICS.get_summary()}')
+
+
+    def stop(self):
+        self.stopped.set()
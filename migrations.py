@@ -0,0 +1,172 @@
+'''
+ordered schema migrations, applied by Database.initialize
+
+each migration is run inside its own transaction and bumps schema_version,
+so append new steps to MIGRATIONS and never edit or reorder existing ones
+'''
+from stats import rebuild_quiz_stats, rebuild_user_stats
+
+
+# local calendar date and morning flag of an epoch timestamp, computed by
+# sqlite (with the same local timezone as datetime.fromtimestamp)
+QUIZ_DATE_SQL   = "date({ts}, 'unixepoch', 'localtime')"
+QUIZ_IS_AM_SQL  = "CAST(strftime('%H', {ts}, 'unixepoch', 'localtime') AS integer) < 12"
+
+
+def rebuild_table(cursor, table, create_sql, columns, select_sql=None):
+    # sqlite can't add keys to an existing table, so copy into a new one
+    select_sql = select_sql or f'SELECT {columns} FROM {table} ORDER BY rowid'
+    cursor.execute(create_sql.format(table=f'{table}_new'))
+    cursor.execute(f'INSERT OR IGNORE INTO {table}_new ({columns}) {select_sql};')
+    cursor.execute(f'DROP TABLE {table};')
+    cursor.execute(f'ALTER TABLE {table}_new RENAME TO {table};')
+
+
+def create_tables(cursor):
+    # the original schema, existing databases already have these
+    cursor.execute(
+        'CREATE TABLE IF NOT EXISTS channels (id string, name string);'
+    )
+    cursor.execute(
+        'CREATE TABLE IF NOT EXISTS users (id string, name string);'
+    )
+    cursor.execute(
+        'CREATE TABLE IF NOT EXISTS scores (user_id string, quiz_id string, channel_id string, score integer, ts string);'
+    )
+    cursor.execute(
+        'CREATE TABLE IF NOT EXISTS quizzes (id string, name string, url string, ts string);'
+    )
+
+
+def add_keys_and_indexes(cursor):
+    # duplicate rows (from racing inserts) are dropped, keeping the first one added
+    rebuild_table(
+        cursor,
+        'channels',
+        'CREATE TABLE {table} (id text PRIMARY KEY, name text);',
+        'id, name'
+    )
+    rebuild_table(
+        cursor,
+        'users',
+        'CREATE TABLE {table} (id text PRIMARY KEY, name text);',
+        'id, name'
+    )
+    rebuild_table(
+        cursor,
+        'quizzes',
+        'CREATE TABLE {table} (id text PRIMARY KEY, name text, url text, ts string);',
+        'id, name, url, ts'
+    )
+    rebuild_table(
+        cursor,
+        'scores',
+        (
+            'CREATE TABLE {table} ('
+            'user_id text NOT NULL, '
+            'quiz_id text NOT NULL, '
+            'channel_id text, '
+            'score integer, '
+            'ts string, '
+            'UNIQUE (user_id, quiz_id)'
+            ');'
+        ),
+        'user_id, quiz_id, channel_id, score, ts'
+    )
+    cursor.execute('CREATE INDEX quizzes_ts ON quizzes (ts);')
+    cursor.execute('CREATE INDEX scores_user_id_ts ON scores (user_id, ts);')
+
+
+def use_real_timestamps(cursor):
+    # timestamps were written as strings, store epoch seconds as REAL so
+    # range queries compare numbers and can use the indexes. quizzes also
+    # get their local date and am/pm half precomputed for find_quiz
+    rebuild_table(
+        cursor,
+        'quizzes',
+        (
+            'CREATE TABLE {table} ('
+            'id text PRIMARY KEY, '
+            'name text, '
+            'url text, '
+            'ts real, '
+            'quiz_date text, '
+            'is_am integer'
+            ');'
+        ),
+        'id, name, url, ts, quiz_date, is_am',
+        (
+            'SELECT id, name, url, ts, '
+            f'{QUIZ_DATE_SQL.format(ts="ts")}, '
+            f'{QUIZ_IS_AM_SQL.format(ts="ts")} '
+            'FROM (SELECT id, name, url, CAST(ts AS real) AS ts FROM quizzes ORDER BY rowid)'
+        )
+    )
+    rebuild_table(
+        cursor,
+        'scores',
+        (
+            'CREATE TABLE {table} ('
+            'user_id text NOT NULL, '
+            'quiz_id text NOT NULL, '
+            'channel_id text, '
+            'score integer, '
+            'ts real, '
+            'UNIQUE (user_id, quiz_id)'
+            ');'
+        ),
+        'user_id, quiz_id, channel_id, score, ts',
+        (
+            'SELECT user_id, quiz_id, channel_id, score, CAST(ts AS real) '
+            'FROM scores ORDER BY rowid'
+        )
+    )
+    cursor.execute('CREATE INDEX quizzes_ts ON quizzes (ts);')
+    cursor.execute('CREATE INDEX quizzes_quiz_date ON quizzes (quiz_date, is_am, ts);')
+    cursor.execute('CREATE INDEX scores_user_id_ts ON scores (user_id, ts);')
+
+
+def add_user_stats(cursor):
+    # per-user totals and newest scores for the leaderboard, see stats.py
+    cursor.execute(
+        'CREATE TABLE user_stats ('
+        'user_id text PRIMARY KEY, '
+        'total_quizzes integer NOT NULL, '
+        'total_score integer NOT NULL, '
+        'recent_scores text NOT NULL'
+        ');'
+    )
+    # the 28 day leaderboard totals up a window of recent scores
+    cursor.execute('CREATE INDEX scores_ts ON scores (ts);')
+    rebuild_user_stats(cursor)
+
+
+def add_quiz_stats(cursor):
+    # per-quiz totals and winner for !quizstats, see stats.py
+    cursor.execute(
+        'CREATE TABLE quiz_stats ('
+        'quiz_id text PRIMARY KEY, '
+        'quiz_ts real, '
+        'total_scores integer NOT NULL, '
+        'total_score integer NOT NULL, '
+        'average_score real NOT NULL, '
+        'win_score integer NOT NULL, '
+        'win_user_id text, '
+        'is_draw integer NOT NULL'
+        ');'
+    )
+    # quizzes need more than 1 participant to be ranked
+    cursor.execute(
+        'CREATE INDEX quiz_stats_average_score ON quiz_stats (average_score, quiz_ts) '
+        'WHERE total_scores > 1;'
+    )
+    rebuild_quiz_stats(cursor)
+
+
+MIGRATIONS = (
+    create_tables,
+    add_keys_and_indexes,
+    use_real_timestamps,
+    add_user_stats,
+    add_quiz_stats,
+)
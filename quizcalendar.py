@@ -0,0 +1,65 @@
+import datetime
+import threading
+
+
+class QuizCalendar():
+    '''
+    the quizzes by local date and half of the day, so a score can be matched
+    to its quiz without a query. it's loaded from the database at startup
+    and added to as quizzes are
+
+    find_quiz_id(ts, is_am, is_pm, days_ago) gives the same quiz as
+    Database.find_quiz: the am or pm quiz on the day, otherwise the latest
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        # date -> ((ts, quiz id) of the latest am quiz, same for pm)
+        self.days = {}
+
+
+    def load(self, quizzes):
+        # quizzes are (quiz id, ts)
+        days = {}
+        for quiz_id, ts in quizzes:
+            add_to_days(days, quiz_id, float(ts))
+        with self.lock:
+            self.days = days
+
+
+    def add(self, quiz_id, ts):
+        with self.lock:
+            add_to_days(self.days, quiz_id, float(ts))
+
+
+    def find_quiz_id(self, ts, is_am, is_pm, days_ago=0):
+        # shift ts to the correct day
+        timestamp = float(ts) - (24 * 60 * 60 * days_ago)
+        day = self.days.get(datetime.date.fromtimestamp(timestamp))
+        if day is None:
+            return None
+        am_quiz, pm_quiz = day
+        if is_am:
+            quiz = am_quiz
+        elif is_pm:
+            quiz = pm_quiz
+        else:
+            # the latest quiz that day
+            quiz = max((quiz for quiz in day if quiz is not None), default=None)
+        return quiz[1] if quiz else None
+
+
+    def __len__(self):
+        return sum(quiz is not None for day in self.days.values() for quiz in day)
+
+
+def add_to_days(days, quiz_id, ts):
+    quiz_datetime = datetime.datetime.fromtimestamp(ts)
+    am_quiz, pm_quiz = days.get(quiz_datetime.date(), (None, None))
+    # like find_quiz, the latest quiz in each half wins
+    if quiz_datetime.hour < 12:
+        if am_quiz is None or ts >= am_quiz[0]:
+            am_quiz = (ts, quiz_id)
+    elif pm_quiz is None or ts >= pm_quiz[0]:
+        pm_quiz = (ts, quiz_id)
+    # replaced, not changed, so readers don't need the lock
+    days[quiz_datetime.date()] = (am_quiz, pm_quiz)
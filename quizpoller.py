@@ -0,0 +1,481 @@
+import os
+import json
+import time
+import random
+import hashlib
+import datetime
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import urllib3
+
+from dispatcher import RateLimiter
+from metrics import METRICS
+
+
+# inside a poll window, polls start this often and slow down to the max
+# until that window's quiz turns up
+POLL_FIRST_SECONDS  = 15
+POLL_MAX_SECONDS    = 95
+POLL_GROWTH         = 1.5
+# +/- this fraction of every wait, so restarts don't line up
+POLL_JITTER         = 0.2
+ERROR_BACKOFF_SECONDS       = 10
+MAX_ERROR_BACKOFF_SECONDS   = 5 * 60
+# the longest the poller sleeps before working out the waits again
+# (e.g. the clock changed)
+MAX_WAIT_SECONDS    = 15 * 60
+# a quiz dated this long before a window opens still counts as its quiz
+QUIZ_EARLY_SECONDS  = 30 * 60
+# where each source's state is kept between restarts, '' turns it off
+POLLER_STATE_DIR    = os.environ.get('POLLER_STATE_DIR', '.')
+# quiz timestamps kept in a state file, the oldest are dropped past this
+MAX_STATE_QUIZZES   = 500
+# a restart this soon after a successful poll doesn't force another one
+RESTART_CHECK_SECONDS = 10 * 60
+# sources checked at once, and detail pages fetched at once (across all
+# sources). these are the only threads the poller adds
+SOURCE_WORKERS  = 2
+DETAIL_WORKERS  = 4
+# requests per second (and how many can go at once) to a source, unless
+# it says otherwise
+DEFAULT_SOURCE_RATE_LIMIT = (1, 4)
+REQUEST_TIMEOUT = urllib3.Timeout(connect=5, read=15)
+REQUEST_RETRIES = urllib3.Retry(
+    total=3,
+    backoff_factor=0.5,
+    status_forcelist=(429, 500, 502, 503, 504)
+)
+CUSTOM_USER_AGENT = (
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
+    'AppleWebKit/537.36 (KHTML, like Gecko) '
+    'Chrome/87.0.4280.88 '
+    'Safari/537.36'
+)
+
+POLLER_SECONDS  = METRICS.histogram('poller_seconds', 'Time taken by each step of polling a quiz source', ('source', 'step'))
+POLLER_CHECKS   = METRICS.counter('poller_checks_total', 'Quiz source checks by outcome', ('source', 'outcome'))
+
+
+def get_poll_window(now, poll_windows):
+    # the (start, end) datetimes of the window now is in, if any
+    for start_time, end_time in poll_windows:
+        if start_time <= now.time() < end_time:
+            return (
+                datetime.datetime.combine(now.date(), start_time),
+                datetime.datetime.combine(now.date(), end_time)
+            )
+    return None
+
+
+def get_next_poll_window_start(now, poll_windows):
+    starts = [
+        datetime.datetime.combine(now.date() + datetime.timedelta(days=days), start_time)
+        for days in (0, 1)
+        for start_time, _ in poll_windows
+    ]
+    return min(start for start in starts if start > now)
+
+
+def get_jittered(seconds):
+    return seconds * random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+
+
+class QuizSource():
+    '''
+    somewhere quizzes are published. a source says where its list page is,
+    how to pull the quiz links and ids out of it and how to get a quiz's
+    timestamp from the quiz's own page
+
+    ids share the quizzes table with every other source, so a new source
+    should prefix its ids with its name
+    '''
+    name = None
+    list_url = None
+    # (start, end) times of day the source publishes quizzes
+    poll_windows = ()
+    rate_limit = DEFAULT_SOURCE_RATE_LIMIT
+    user_agent = CUSTOM_USER_AGENT
+
+
+    def extract_quiz_links(self, html):
+        # [(name, href)] on the list page, oldest first
+        raise NotImplementedError()
+
+
+    def get_quiz_id(self, href):
+        raise NotImplementedError()
+
+
+    def get_quiz_url(self, href):
+        return urllib.parse.urljoin(self.list_url, href)
+
+
+    def extract_quiz_ts(self, html):
+        # the quiz's timestamp from its page
+        raise NotImplementedError()
+
+
+class Quiz():
+    def __init__(self, source, name, href):
+        self.source = source
+        self.id = source.get_quiz_id(href)
+        self.name = name.strip()
+        self.href = href
+        self.url = source.get_quiz_url(href)
+        # this requires a GET
+        self.ts = None
+
+
+def get_quizzes_from_links(source, quiz_links):
+    quizzes = []
+    for name, href in quiz_links:
+        try:
+            quizzes.append(Quiz(source, name, href))
+        except Exception as e:
+            # one odd link shouldn't lose the rest of the list
+            print(f'skipping {source.name} quiz link {href!r}: {e}')
+    return quizzes
+
+
+class PollerState():
+    '''
+    what the poller knows about a source, kept in a small json file so a
+    restart (or a crash loop) doesn't fetch everything again: the list's
+    etag, last-modified and hash, the quiz links parsed from it, when it was
+    last polled and the timestamps from quiz pages. only the newest
+    max_quizzes timestamps are kept
+    '''
+    def __init__(self, file_name, max_quizzes=MAX_STATE_QUIZZES):
+        self.file_name = file_name
+        self.max_quizzes = max_quizzes
+        self.etag = None
+        self.last_modified = None
+        self.list_hash = None
+        # (name, href) of the quizzes on the list, oldest first
+        self.quiz_links = []
+        self.polled_at = None
+        # quiz id -> ts
+        self.quiz_ts = {}
+
+
+    def load(self):
+        if not self.file_name or not os.path.exists(self.file_name):
+            return
+        try:
+            with open(self.file_name) as f:
+                data = json.load(f)
+            quiz_links = [(name, href) for name, href in data['quiz_links']]
+            quiz_ts = {quiz_id: float(ts) for quiz_id, ts in data['quiz_ts'].items()}
+        except (OSError, ValueError, TypeError, KeyError, AttributeError) as e:
+            # start from scratch rather than trust it
+            print(f'ignoring poller state in {self.file_name}: {e}')
+            return
+        self.etag = data.get('etag')
+        self.last_modified = data.get('last_modified')
+        self.list_hash = data.get('list_hash')
+        self.quiz_links = quiz_links
+        self.polled_at = data.get('polled_at')
+        self.quiz_ts = quiz_ts
+        self.evict()
+        print(f'loaded poller state from {self.file_name} ({len(self.quiz_links)} quizzes listed, {len(self.quiz_ts)} timestamps)')
+
+
+    def add_quiz_ts(self, quiz_id, ts):
+        self.quiz_ts[quiz_id] = ts
+        self.evict()
+
+
+    def evict(self):
+        if len(self.quiz_ts) <= self.max_quizzes:
+            return
+        oldest_quiz_ids = sorted(self.quiz_ts, key=self.quiz_ts.get)[:len(self.quiz_ts) - self.max_quizzes]
+        for quiz_id in oldest_quiz_ids:
+            del self.quiz_ts[quiz_id]
+
+
+    def save(self):
+        if not self.file_name:
+            return
+        data = {
+            'etag': self.etag,
+            'last_modified': self.last_modified,
+            'list_hash': self.list_hash,
+            'quiz_links': self.quiz_links,
+            'polled_at': self.polled_at,
+            'quiz_ts': self.quiz_ts
+        }
+        # written alongside then swapped in, so a crash can't leave half a file
+        temp_file_name = self.file_name + '.tmp'
+        try:
+            with open(temp_file_name, 'w') as f:
+                json.dump(data, f)
+            os.replace(temp_file_name, self.file_name)
+        except OSError as e:
+            print(f'could not save poller state to {self.file_name}: {e}')
+
+
+def get_state_file_name(source, state_dir=POLLER_STATE_DIR):
+    if not state_dir:
+        return None
+    return os.path.join(state_dir, f'{source.name}-state.json')
+
+
+class SourcePoller():
+    '''
+    one source's schedule and state inside a QuizPoller
+
+    between the source's poll windows it waits for the next one to open.
+    inside a window it polls every POLL_FIRST_SECONDS, slowing down to
+    POLL_MAX_SECONDS, and stops once that window's quiz is found. errors
+    are retried with exponential backoff
+    '''
+    def __init__(self, source, known_quiz_ids=(), state=None):
+        self.source = source
+        self.seen_quiz_ids = set(known_quiz_ids)
+        if state is None:
+            state = PollerState(get_state_file_name(source))
+            state.load()
+        self.state = state
+        # quizzes parsed from the list the last time it changed
+        self.quizzes = get_quizzes_from_links(source, state.quiz_links)
+        # the newest quiz the poller has seen the details of
+        self.latest_quiz_ts = max(state.quiz_ts.values(), default=None)
+        polled_seconds_ago = time.time() - state.polled_at if state.polled_at else None
+        # polling again straight after a restart just fetches the same thing
+        self.force_check = polled_seconds_ago is None or polled_seconds_ago > RESTART_CHECK_SECONDS
+        if not self.force_check:
+            print(f'{source.name} was polled {polled_seconds_ago:.0f}s ago, not checking it on start')
+        # a check is running on a worker
+        self.checking = False
+        # scheduling: when to poll next inside a window (or retry an error),
+        # how long the wait after that is, and the window already done
+        self.next_check_at = None
+        self.poll_seconds = POLL_FIRST_SECONDS
+        self.error_count = 0
+        self.found_window = None
+
+
+    def get_wait_seconds(self):
+        if self.force_check:
+            return 0
+        now = datetime.datetime.now()
+        if self.error_count:
+            # retrying, whether or not it's in a window
+            return self.next_check_at - now.timestamp()
+        window = get_poll_window(now, self.source.poll_windows)
+        if window is None or window == self.found_window:
+            self.next_check_at = None
+            self.poll_seconds = POLL_FIRST_SECONDS
+            return (get_next_poll_window_start(now, self.source.poll_windows) - now).total_seconds()
+        if self.next_check_at is None:
+            # the window has just opened
+            return 0
+        return self.next_check_at - now.timestamp()
+
+
+    def succeeded(self, window):
+        self.error_count = 0
+        self.state.polled_at = time.time()
+        self.state.save()
+        if window is not None and window != self.found_window and self.has_quiz_for_window(window):
+            print(f'found the {self.source.name} quiz for the {window[0]:%H:%M} window')
+            self.found_window = window
+        self.next_check_at = time.time() + get_jittered(self.poll_seconds)
+        self.poll_seconds = min(POLL_MAX_SECONDS, self.poll_seconds * POLL_GROWTH)
+
+
+    def failed(self):
+        self.error_count += 1
+        backoff_seconds = min(MAX_ERROR_BACKOFF_SECONDS, ERROR_BACKOFF_SECONDS * 2 ** (self.error_count - 1))
+        self.next_check_at = time.time() + get_jittered(backoff_seconds)
+
+
+    def has_quiz_for_window(self, window):
+        window_start_ts = window[0].timestamp()
+        return self.latest_quiz_ts is not None and self.latest_quiz_ts >= window_start_ts - QUIZ_EARLY_SECONDS
+
+
+class QuizPoller(threading.Thread):
+    '''
+    polls every source's quiz list and calls on_new_quiz for quizzes it
+    hasn't seen before, oldest first for each source
+
+    lists are fetched conditionally (etag/last-modified) and only parsed
+    when their content changes, and details are only fetched for quiz ids
+    not in known_quiz_ids, the source's state or already processed, so a
+    poll that finds nothing new is a single (usually 304) request
+
+    sources share one connection pool and a fixed number of workers, so a
+    slow source doesn't hold up the others and adding one adds no threads.
+    each source's requests are paced by its rate_limit. check_now() and
+    stop() wake the poller straight away
+    '''
+    def __init__(self, sources, known_quiz_ids=()):
+        super().__init__(name='quiz-poller')
+        for source in sources:
+            if not source.poll_windows:
+                raise ValueError(f'{source.name} has no poll windows')
+        self.alive = True
+        self.wake = threading.Event()
+        self.source_pollers = [SourcePoller(source, known_quiz_ids) for source in sources]
+        self.rate_limiter = RateLimiter(
+            rate_limits={source.name: source.rate_limit for source in sources},
+            default_rate_limit=DEFAULT_SOURCE_RATE_LIMIT
+        )
+        # new quizzes are handled one at a time, whichever source they're from
+        self.new_quiz_lock = threading.Lock()
+        self.check_executor = ThreadPoolExecutor(max_workers=SOURCE_WORKERS, thread_name_prefix='quiz-checks')
+        self.detail_executor = ThreadPoolExecutor(max_workers=DETAIL_WORKERS, thread_name_prefix='quiz-details')
+
+
+    def run(self):
+        proxy = os.environ.get("PROXY")
+        # enough connections for all the workers to share
+        http_options = {
+            'timeout': REQUEST_TIMEOUT,
+            'retries': REQUEST_RETRIES,
+            'maxsize': SOURCE_WORKERS + DETAIL_WORKERS
+        }
+        if proxy:
+            self.http = urllib3.ProxyManager(proxy, **http_options)
+        else:
+            self.http = urllib3.PoolManager(**http_options)
+
+        while self.alive:
+            # cleared before working out the waits, so a wake-up isn't missed
+            self.wake.clear()
+            wait_seconds = MAX_WAIT_SECONDS
+            for source_poller in self.source_pollers:
+                if source_poller.checking:
+                    continue
+                # one source going wrong mustn't stop the others being polled
+                try:
+                    source_wait_seconds = source_poller.get_wait_seconds()
+                    if source_wait_seconds > 0:
+                        wait_seconds = min(wait_seconds, source_wait_seconds)
+                        continue
+                    source_poller.checking = True
+                    self.check_executor.submit(self.check_source, source_poller)
+                except Exception as e:
+                    print(f'could not schedule a {source_poller.source.name} check: {e}')
+                    source_poller.checking = False
+            self.wake.wait(wait_seconds)
+        self.check_executor.shutdown()
+        self.detail_executor.shutdown()
+
+
+    def check_source(self, source_poller):
+        source = source_poller.source
+        if source_poller.force_check:
+            print(f'forcing a {source.name} check')
+            # only check once
+            source_poller.force_check = False
+        window = get_poll_window(datetime.datetime.now(), source.poll_windows)
+        try:
+            print(f'retrieving quizzes from {source.name}...')
+            quizzes = self.get_quizzes(source_poller)
+            print(f'retrieved {len(quizzes)} quizzes from {source.name}')
+            self.process_quizzes(source_poller, quizzes)
+            source_poller.succeeded(window)
+        except Exception as e:
+            print(f'error getting/processing {source.name} quizzes: {e}')
+            POLLER_CHECKS.inc(source=source.name, outcome='error')
+            source_poller.failed()
+        finally:
+            source_poller.checking = False
+            # its next check needs scheduling
+            self.wake.set()
+
+
+    def request(self, source, step, url, headers=None):
+        wait_seconds = self.rate_limiter.reserve((source.name, None))
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+        headers = dict(headers or {}, **{'User-Agent': source.user_agent})
+        with POLLER_SECONDS.time(source=source.name, step=step):
+            return self.http.request('GET', url, headers=headers)
+
+
+    def get_quizzes(self, source_poller):
+        source = source_poller.source
+        state = source_poller.state
+        headers = {}
+        if state.etag:
+            headers['If-None-Match'] = state.etag
+        if state.last_modified:
+            headers['If-Modified-Since'] = state.last_modified
+        response = self.request(source, 'fetch-list', source.list_url, headers)
+        if response.status == 304:
+            POLLER_CHECKS.inc(source=source.name, outcome='not-modified')
+            return source_poller.quizzes
+        if response.status != 200:
+            raise Exception(f'quiz list returned http {response.status}')
+        # the page can be served again without an etag, so check what's in it
+        list_hash = hashlib.sha256(response.data).hexdigest()
+        if list_hash == state.list_hash:
+            POLLER_CHECKS.inc(source=source.name, outcome='unchanged')
+            state.etag = response.headers.get('ETag')
+            state.last_modified = response.headers.get('Last-Modified')
+            return source_poller.quizzes
+        POLLER_CHECKS.inc(source=source.name, outcome='changed')
+        with POLLER_SECONDS.time(source=source.name, step='parse-list'):
+            quizzes = get_quizzes_from_links(source, source.extract_quiz_links(response.data))
+        source_poller.quizzes = quizzes
+        state.quiz_links = [(quiz.name, quiz.href) for quiz in quizzes]
+        # only once it's parsed, so a page that fails to parse isn't 304'd
+        # next time and is tried again
+        state.etag = response.headers.get('ETag')
+        state.last_modified = response.headers.get('Last-Modified')
+        state.list_hash = list_hash
+        return quizzes
+
+
+    def attach_quiz_details(self, source_poller, quiz):
+        cached_ts = source_poller.state.quiz_ts.get(quiz.id)
+        if cached_ts is not None:
+            quiz.ts = cached_ts
+            return
+        # makes a request for more details about this quiz
+        source = source_poller.source
+        print(f'retrieving additional data for quiz {quiz.id} from {quiz.url}')
+        response = self.request(source, 'fetch-details', quiz.url)
+        if response.status != 200:
+            raise Exception(f'quiz page returned http {response.status}')
+        with POLLER_SECONDS.time(source=source.name, step='parse-details'):
+            quiz.ts = source.extract_quiz_ts(response.data)
+
+
+    def process_quizzes(self, source_poller, quizzes):
+        if not hasattr(self, 'on_new_quiz'):
+            return
+        new_quizzes = [quiz for quiz in quizzes if quiz.id not in source_poller.seen_quiz_ids]
+        # fetch all the details at once, but handle them in order
+        futures = [
+            self.detail_executor.submit(self.attach_quiz_details, source_poller, quiz)
+            for quiz in new_quizzes
+        ]
+        for quiz, future in zip(new_quizzes, futures):
+            try:
+                future.result()
+                source_poller.state.add_quiz_ts(quiz.id, quiz.ts)
+                with self.new_quiz_lock:
+                    self.on_new_quiz(quiz)
+            except Exception as e:
+                # not seen, so it's tried again next time
+                print(f'could not process {source_poller.source.name} quiz {quiz.id}: {e}')
+                continue
+            source_poller.seen_quiz_ids.add(quiz.id)
+            source_poller.latest_quiz_ts = max(source_poller.latest_quiz_ts or 0, quiz.ts)
+
+
+    def check_now(self):
+        for source_poller in self.source_pollers:
+            source_poller.force_check = True
+        self.wake.set()
+
+
+    def stop(self):
+        self.alive = False
+        self.wake.set()
@@ -0,0 +1,27 @@
+class CommandRouter():
+    '''
+    routes "!command" messages to their handler through a prefix table
+
+    commands are matched in the order they were added, either on a prefix of
+    the lowercased text or (exact=True) on the whole of it
+    '''
+    def __init__(self):
+        self.commands = []
+
+
+    def add(self, prefix, handler, exact=False):
+        self.commands.append((prefix, exact, handler))
+
+
+    def match(self, text):
+        # cheap reject for everything that isn't a command
+        if not text.startswith('!'):
+            return None, None
+        text_lower = text.lower()
+        for prefix, exact, handler in self.commands:
+            if exact:
+                if text_lower == prefix:
+                    return prefix, handler
+            elif text_lower.startswith(prefix):
+                return prefix, handler
+        return None, None
@@ -0,0 +1,115 @@
+import re
+import datetime
+
+
+# aligned with datetime days of the week (monday=0 etc.)
+WEEK_DAYS = (
+    ('monday', 'mon'),
+    ('tuesday', 'tues'),
+    ('wednesday', 'wed'),
+    ('thursday', 'thurs'),
+    ('friday', 'fri'),
+    ('saturday', 'sat'),
+    ('sunday', 'sun')
+)
+QUIZ_DAYS_OF_WEEK = (0, 1, 2, 3, 4)
+
+SCORE_PATTERN = re.compile(r'([0-9]{1,2})/15')
+EMOJI_PATTERN = re.compile(r':[0-9A-Za-z._-]+:')
+
+# marker text -> what it marks: 'am', 'pm', 'today', 'yesterday' or a week day
+MARKER_KINDS = {
+    'am': 'am',
+    'a.m': 'am',
+    'morning': 'am',
+    'pm': 'pm',
+    'p.m': 'pm',
+    'afternoon': 'pm',
+    'today': 'today',
+    'yesterday': 'yesterday'
+}
+for day, names in enumerate(WEEK_DAYS):
+    for name in names:
+        MARKER_KINDS[name] = day
+
+
+def get_trie_pattern(words):
+    '''
+    returns a regex matching any of the words, factored into a trie (e.g.
+    "mo(?:n(?:day)?|rning)") so each position is dispatched on its first
+    character instead of trying every word in turn. longest words win
+    '''
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def get_node_pattern(node):
+        alternatives = [
+            re.escape(char) + get_node_pattern(child)
+            for char, child in sorted(node.items())
+            if char != ''
+        ]
+        if not alternatives:
+            return ''
+        if len(alternatives) == 1:
+            pattern = alternatives[0]
+        else:
+            pattern = '(?:' + '|'.join(alternatives) + ')'
+        if '' in node:
+            pattern = '(?:' + pattern + ')?'
+        return pattern
+
+    return get_node_pattern(trie)
+
+
+# every marker in one pattern. it's a zero-width lookahead so that markers
+# are matched as substrings anywhere, even when they overlap each other
+# (e.g. the "am" and "mon" in "samon"), just like `marker in text`
+MARKER_PATTERN = re.compile('(?=(' + get_trie_pattern(MARKER_KINDS) + '))')
+
+
+def parse_line_markers(line, today_day):
+    '''
+    returns (is_am, is_pm, days_ago) for a line of text
+    '''
+    if ':' in line:
+        line = EMOJI_PATTERN.sub('', line)
+    kinds = {MARKER_KINDS[marker] for marker in MARKER_PATTERN.findall(line.lower())}
+    is_am = 'am' in kinds
+    is_pm = 'pm' in kinds
+    if 'today' in kinds:
+        return is_am, is_pm, 0
+    if 'yesterday' in kinds:
+        return is_am, is_pm, 1
+    # is a weekday name provided? the earliest day in the week wins
+    for day in range(len(WEEK_DAYS)):
+        if day in kinds:
+            return is_am, is_pm, (today_day - day) % 7
+    # assume today
+    return is_am, is_pm, 0
+
+
+def parse_text_for_scores(text, today=None):
+    '''
+    returns scores in the given text as a list of
+    [
+        (score, is_am, is_pm, days_ago)
+        ...
+    ]
+    '''
+    # what day is today?
+    today_day = (today or datetime.date.today()).weekday()
+    parsed_scores = []
+    for line in text.split('\n'):
+        # use the first score on this line
+        match = SCORE_PATTERN.search(line)
+        if match is None:
+            continue
+        score = int(match.group(1))
+        if score > 15:
+            continue
+        parsed_scores.append((score,) + parse_line_markers(line, today_day))
+    return parsed_scores
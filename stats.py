@@ -0,0 +1,134 @@
+'''
+incrementally maintained aggregates, updated in the same transaction as the
+score they describe and rebuildable from the raw scores table
+
+these work on a bare cursor so the migrations can use them too
+'''
+import json
+
+
+# enough to work out the last 10 and the 10 before the latest
+RECENT_SCORES_LENGTH = 11
+# quiz_stats totals before any scores
+EMPTY_QUIZ_TOTALS = (0, 0, -1, None, False)
+
+
+def get_recent_score_key(entry):
+    # newest first: quiz time (quizzes without a time last), then score time
+    quiz_ts, score_ts, score = entry
+    return (quiz_ts is not None, quiz_ts or 0, score_ts or 0)
+
+
+def merge_recent_score(recent_scores, entry):
+    key = get_recent_score_key(entry)
+    for index, existing_entry in enumerate(recent_scores):
+        if key > get_recent_score_key(existing_entry):
+            recent_scores.insert(index, entry)
+            break
+    else:
+        recent_scores.append(entry)
+    del recent_scores[RECENT_SCORES_LENGTH:]
+    return recent_scores
+
+
+def add_user_score(cursor, user_id, score, quiz_ts, score_ts):
+    cursor.execute(
+        'SELECT total_quizzes, total_score, recent_scores '
+        'FROM user_stats '
+        'WHERE user_id = ?;',
+        (user_id,)
+    )
+    row = cursor.fetchone()
+    if row:
+        total_quizzes, total_score, recent_scores = row
+        recent_scores = json.loads(recent_scores)
+    else:
+        total_quizzes, total_score, recent_scores = 0, 0, []
+    merge_recent_score(recent_scores, [quiz_ts, score_ts, score])
+    cursor.execute(
+        'INSERT OR REPLACE INTO user_stats (user_id, total_quizzes, total_score, recent_scores) '
+        'VALUES (?, ?, ?, ?);',
+        (user_id, total_quizzes + 1, total_score + score, json.dumps(recent_scores))
+    )
+
+
+def rebuild_user_stats(cursor):
+    cursor.execute('DELETE FROM user_stats;')
+    cursor.execute(
+        'SELECT scores.user_id, scores.score, quizzes.ts, scores.ts '
+        'FROM scores '
+        'LEFT OUTER JOIN quizzes ON scores.quiz_id = quizzes.id '
+        'ORDER BY scores.user_id, quizzes.ts DESC, scores.ts DESC;'
+    )
+    users = {}
+    for user_id, score, quiz_ts, score_ts in cursor.fetchall():
+        if user_id not in users:
+            users[user_id] = [0, 0, []]
+        user = users[user_id]
+        user[0] += 1
+        user[1] += score
+        # rows arrive newest first
+        if len(user[2]) < RECENT_SCORES_LENGTH:
+            user[2].append([quiz_ts, score_ts, score])
+    cursor.executemany(
+        'INSERT INTO user_stats (user_id, total_quizzes, total_score, recent_scores) '
+        'VALUES (?, ?, ?, ?);',
+        (
+            (user_id, total_quizzes, total_score, json.dumps(recent_scores))
+            for user_id, (total_quizzes, total_score, recent_scores) in users.items()
+        )
+    )
+
+
+def add_to_quiz_totals(totals, user_id, score):
+    # totals are (total_scores, total_score, win_score, win_user_id, is_draw)
+    total_scores, total_score, win_score, win_user_id, is_draw = totals
+    # update winner, the first to get the top score holds it unless drawn
+    if score > win_score:
+        win_score, win_user_id, is_draw = score, user_id, False
+    elif score == win_score:
+        is_draw = True
+    return (total_scores + 1, total_score + score, win_score, win_user_id, is_draw)
+
+
+def get_quiz_stats_row(quiz_id, quiz_ts, totals):
+    total_scores, total_score, win_score, win_user_id, is_draw = totals
+    return (quiz_id, quiz_ts, total_scores, total_score, total_score / total_scores, win_score, win_user_id, is_draw)
+
+
+def add_quiz_score(cursor, quiz_id, quiz_ts, user_id, score):
+    cursor.execute(
+        'SELECT total_scores, total_score, win_score, win_user_id, is_draw '
+        'FROM quiz_stats '
+        'WHERE quiz_id = ?;',
+        (quiz_id,)
+    )
+    totals = cursor.fetchone() or EMPTY_QUIZ_TOTALS
+    totals = add_to_quiz_totals(totals, user_id, score)
+    cursor.execute(
+        'INSERT OR REPLACE INTO quiz_stats '
+        '(quiz_id, quiz_ts, total_scores, total_score, average_score, win_score, win_user_id, is_draw) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?);',
+        get_quiz_stats_row(quiz_id, quiz_ts, totals)
+    )
+
+
+def rebuild_quiz_stats(cursor):
+    cursor.execute('DELETE FROM quiz_stats;')
+    cursor.execute(
+        'SELECT scores.quiz_id, quizzes.ts, scores.user_id, scores.score '
+        'FROM scores '
+        'JOIN quizzes ON scores.quiz_id = quizzes.id '
+        'ORDER BY scores.rowid;'
+    )
+    # quiz id -> (quiz ts, totals), adding the scores in the order they were
+    quizzes = {}
+    for quiz_id, quiz_ts, user_id, score in cursor.fetchall():
+        _, totals = quizzes.get(quiz_id, (quiz_ts, EMPTY_QUIZ_TOTALS))
+        quizzes[quiz_id] = (quiz_ts, add_to_quiz_totals(totals, user_id, score))
+    cursor.executemany(
+        'INSERT INTO quiz_stats '
+        '(quiz_id, quiz_ts, total_scores, total_score, average_score, win_score, win_user_id, is_draw) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?);',
+        (get_quiz_stats_row(quiz_id, quiz_ts, totals) for quiz_id, (quiz_ts, totals) in quizzes.items())
+    )
@@ -0,0 +1,136 @@
+import queue
+import time
+import threading
+from concurrent.futures import Future
+
+from db import Database
+from metrics import METRICS
+
+
+# a batch is committed once it is this old or this big, whichever is first
+BATCH_SECONDS   = 0.02
+BATCH_SIZE      = 100
+
+WRITER_BATCH_SECONDS = METRICS.histogram('writer_batch_seconds', 'Time to write and commit a batch')
+WRITER_QUEUE_SECONDS = METRICS.histogram('writer_queue_seconds', 'Time writes wait for their batch')
+WRITER_WRITES = METRICS.counter('writer_writes_total', 'Writes committed (or not) by the db-writer')
+
+
+class DatabaseWriter(threading.Thread):
+    '''
+    owns the only writing connection and commits queued writes in batches
+
+    callers submit a Database method name and its arguments and get back a
+    future holding the method's result (or exception) once the batch it was
+    written in has been committed. each write runs in its own savepoint, so
+    a failing write (e.g. a duplicate score) doesn't take its batch down
+    '''
+    def __init__(self, file_name, batch_seconds=BATCH_SECONDS, batch_size=BATCH_SIZE):
+        super().__init__(name='db-writer', daemon=True)
+        self.file_name = file_name
+        self.batch_seconds = batch_seconds
+        self.batch_size = batch_size
+        self.queue = queue.Queue()
+        self.alive = True
+        # contention counters, e.g. for benchmarks/loadgen.py
+        self.batch_count = 0
+        self.write_count = 0
+        self.queue_seconds = 0.0
+        self.max_queue_depth = 0
+
+
+    def submit(self, method_name, *args):
+        future = Future()
+        if not self.alive:
+            future.set_exception(RuntimeError('database writer has stopped'))
+            return future
+        self.queue.put((method_name, args, future, time.monotonic()))
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+        return future
+
+
+    def run(self):
+        with Database(self.file_name) as db:
+            while True:
+                batch = self.get_batch()
+                if batch:
+                    self.write_batch(db, batch)
+                if not self.alive and self.queue.empty():
+                    break
+
+
+    def get_batch(self):
+        item = self.queue.get()
+        if item is None:
+            return []
+        batch = [item]
+        deadline = time.monotonic() + self.batch_seconds
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                break
+            batch.append(item)
+        return batch
+
+
+    def write_batch(self, db, batch):
+        outcomes = []
+        started_at = time.monotonic()
+        self.batch_count += 1
+        self.write_count += len(batch)
+        self.queue_seconds += sum(started_at - submitted_at for _, _, _, submitted_at in batch)
+        for _, _, _, submitted_at in batch:
+            WRITER_QUEUE_SECONDS.observe(started_at - submitted_at)
+        WRITER_WRITES.inc(len(batch))
+        try:
+            db.cursor.execute('BEGIN IMMEDIATE;')
+            for method_name, args, future, _ in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                db.cursor.execute('SAVEPOINT write;')
+                try:
+                    result = getattr(db, method_name)(*args)
+                except Exception as e:
+                    db.cursor.execute('ROLLBACK TO write;')
+                    db.cursor.execute('RELEASE write;')
+                    outcomes.append((future, None, e))
+                else:
+                    db.cursor.execute('RELEASE write;')
+                    outcomes.append((future, result, None))
+            db.commit()
+            WRITER_BATCH_SECONDS.observe(time.monotonic() - started_at)
+        except Exception as e:
+            print(f'could not commit batch of {len(batch)} writes: {e}')
+            if db.conn.in_transaction:
+                db.conn.rollback()
+            for _, _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future, result, exception in outcomes:
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+
+
+    def get_stats(self):
+        return {
+            'batches': self.batch_count,
+            'writes': self.write_count,
+            'average_batch_size': self.write_count / max(1, self.batch_count),
+            'average_queue_seconds': self.queue_seconds / max(1, self.write_count),
+            'max_queue_depth': self.max_queue_depth
+        }
+
+
+    def stop(self):
+        # queued writes are still written
+        self.alive = False
+        self.queue.put(None)